@@ -0,0 +1,75 @@
+from datetime import datetime
+from typing import Dict, Optional
+
+from pymongo.database import Database
+
+from indexer.replay import applied, not_applied
+
+granularities = ["hour", "day"]
+
+
+def bucket_start(time: datetime, granularity: str) -> datetime:
+    if granularity == "hour":
+        return time.replace(minute=0, second=0, microsecond=0)
+    if granularity == "day":
+        return time.replace(hour=0, minute=0, second=0, microsecond=0)
+    raise ValueError(f"Unknown granularity {granularity}, expected one of {granularities}")
+
+
+def _nested(counters: Dict[str, int]) -> dict:
+    """Turn {"harvest.1": 1} into {"harvest": {"1": 1}}."""
+    doc = {}
+    for key, value in counters.items():
+        parent = doc
+        *path, last = key.split(".")
+        for name in path:
+            parent = parent.setdefault(name, {})
+        parent[last] = value
+    return doc
+
+
+# Per land activity rollups, one document per land and time bucket.
+# counters are the fields to increment, e.g. {"harvest.1": 1, "builds": 1}
+# and position the one of the event counted.
+async def record_activity(info, land_id: bytes, block_time: datetime, counters: Dict[str, int], position: int):
+    for granularity in granularities:
+        bucket = {
+            "land_id": land_id,
+            "granularity": granularity,
+            "bucket": bucket_start(block_time, granularity),
+        }
+        existing = await info.storage.find_one("activity", dict(bucket))
+        if applied(existing, position):
+            continue
+        if existing is None:
+            await info.storage.insert_one(
+                "activity",
+                {**bucket, **_nested(counters), "updated_at": block_time, "applied_at": position},
+            )
+        else:
+            await info.storage.find_one_and_update(
+                "activity",
+                not_applied(bucket, position),
+                {"$inc": counters, "$set": {"updated_at": block_time, "applied_at": position}},
+            )
+
+
+def find_activity(
+    db: Database,
+    land_id: bytes,
+    granularity: str,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    limit: int = 0,
+):
+    if granularity not in granularities:
+        raise ValueError(f"Unknown granularity {granularity}, expected one of {granularities}")
+
+    filter = {"land_id": land_id, "granularity": granularity, "_chain.valid_to": None}
+    if since is not None or until is not None:
+        filter["bucket"] = {}
+        if since is not None:
+            filter["bucket"]["$gte"] = bucket_start(since, granularity)
+        if until is not None:
+            filter["bucket"]["$lte"] = until
+    return db["activity"].find(filter).sort("bucket", -1).limit(limit)
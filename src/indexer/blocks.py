@@ -0,0 +1,54 @@
+from datetime import datetime
+from typing import List, Optional
+
+from pymongo.database import Database
+
+
+class BlockBuffer:
+    """Buffer block headers in memory and write them to the db in bulk.
+
+    Each header keeps its own `_chain` information so that the usual
+    invalidation on chain reorganizations removes it. When the indexer is
+    sharded, the headers are written by one shard and have its `_shard`.
+    """
+
+    def __init__(self, db: Database, max_size: int = 100, shard: Optional[int] = None):
+        self._db = db
+        self._max_size = max_size
+        self._shard = shard
+        self._headers: List[dict] = []
+
+    def add(self, header):
+        doc = {
+            "number": header.number,
+            "hash": header.hash,
+            "timestamp": header.timestamp,
+            "_chain": {"valid_from": header.number, "valid_to": None},
+        }
+        if self._shard is not None:
+            doc["_shard"] = self._shard
+        self._headers.append(doc)
+        if len(self._headers) >= self._max_size:
+            self.flush()
+
+    def flush(self):
+        if not self._headers:
+            return
+        self._db["blocks"].insert_many(self._headers, ordered=False)
+        self._headers = []
+
+    def discard_from(self, block_number: int):
+        """Drop the buffered headers invalidated by a reorg."""
+        self._headers = [h for h in self._headers if h["number"] < block_number]
+
+
+# returns the number of the last block with timestamp lower or equal to time
+def get_block_at(db: Database, time: datetime) -> Optional[int]:
+    block = db["blocks"].find_one(
+        {"_chain.valid_to": None, "timestamp": {"$lte": time}},
+        sort=[("timestamp", -1), ("number", -1)],
+        projection={"number": 1},
+    )
+    if block is not None:
+        return block["number"]
+    return None
@@ -0,0 +1,36 @@
+"""Coalescing of identical concurrent reads."""
+
+import asyncio
+from typing import Any, Callable, Dict, Hashable
+
+from indexer.metrics import metrics
+
+
+class SingleFlight:
+    """Share one pending call between the callers asking for the same key.
+
+    The call runs in the default executor, so blocking pymongo queries don't
+    stop the event loop. Callers of the same key get the same result object,
+    they must not modify it.
+    """
+
+    def __init__(self):
+        self._pending: Dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, name: str, key: Hashable, fn: Callable[..., Any], *args) -> Any:
+        metrics.inc("graphql_singleflight_calls_total", resolver=name)
+        key = (name, key)
+        future = self._pending.get(key)
+        if future is not None:
+            metrics.inc("graphql_singleflight_coalesced_total", resolver=name)
+            return await asyncio.shield(future)
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(None, fn, *args)
+        self._pending[key] = future
+        future.add_done_callback(lambda _: self._pending.pop(key, None))
+        # a cancelled caller must not cancel the query of the others
+        return await asyncio.shield(future)
+
+    def __len__(self) -> int:
+        return len(self._pending)
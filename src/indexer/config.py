@@ -0,0 +1,41 @@
+# Shared configuration of the indexer and the GraphQL server.
+# Keep this module free of heavy imports: the API server imports it.
+
+import os
+from functools import lru_cache
+from pathlib import Path
+from typing import List
+
+import tomli
+
+indexer_id = "indexer-all3"
+
+# Game instances indexed by the indexer over one stream, the `[[games]]` of
+# the configuration file (INDEXER_CONFIG, the configuration.toml of the
+# project by default), see indexer.games. They are read by the commands
+# using them, the others run without the file.
+default_config_path = Path(__file__).resolve().parents[2] / "configuration.toml"
+
+
+def load_games(path: str) -> List[dict]:
+    with open(path, "rb") as f:
+        games = tomli.load(f).get("games", [])
+    if not games:
+        raise ValueError(f"No [[games]] in {path}")
+    for game in games:
+        missing = [key for key in ["name", "map_address", "frenslands_address"] if key not in game]
+        if missing:
+            raise ValueError(f"Missing {missing} in the game {game} of {path}")
+        game.setdefault("namespace", "")
+    return games
+
+
+@lru_cache(maxsize=None)
+def get_games() -> List[dict]:
+    return load_games(os.environ.get("INDEXER_CONFIG", default_config_path))
+
+# Event collections stored in buckets, one document per land and range of
+# bucket_blocks blocks, instead of one document per event. Changing them
+# requires indexing again from the beginning (`indexer start --restart`).
+bucketed_collections = []
+bucket_blocks = 1000
@@ -0,0 +1,166 @@
+from typing import Dict, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.database import Database
+
+# append-only collections written by the event handlers, keyed by land_id
+land_event_collections = [
+    "inits",
+    "harvest",
+    "destroy",
+    "build",
+    "repairs",
+    "moves",
+    "fuel",
+    "claims",
+    "resets",
+]
+
+
+# felt fields of the events small enough to be stored as integers
+event_int_fields = {
+    "harvest": ["land_id", "time", "resource_type", "resource_uid", "block_comp", "pos_x", "pos_y"],
+    "fuel": ["land_id", "time", "building_type_id", "building_uid", "pos_x", "pos_y", "nb_blocks"],
+    "build": ["land_id", "time", "building_type_id", "building_uid", "block_comp", "pos_x", "pos_y"],
+    "moves": [
+        "land_id", "time", "infra_type", "infra_type_id", "infra_uid",
+        "pos_x", "pos_y", "new_pos_x", "new_pos_y",
+    ],
+    "repairs": ["land_id", "time", "building_type_id", "building_uid", "pos_x", "pos_y"],
+    "destroy": ["land_id", "time", "building_type_id", "building_uid", "block_comp", "pos_x", "pos_y"],
+    "claims": ["land_id", "time", "block_number", "building_counter"],
+    "transfers": [],
+}
+
+
+def get_db_name(indexer_id: str) -> str:
+    """Name of the Mongo database used by the indexer."""
+    return indexer_id.replace("-", "_")
+
+
+def get_indexed_to(db: Database, indexer_id: Optional[str] = None) -> Optional[int]:
+    """Last block indexed by indexer_id, the lowest of the indexers of db by default.
+
+    The shards of a sharded indexer each have their own state, the documents
+    are complete up to the block all of them indexed.
+    """
+    filter = {} if indexer_id is None else {"indexer_id": indexer_id}
+    heights = [state.get("indexed_to") for state in db["_apibara"].find(filter, {"indexed_to": 1})]
+    if not heights or None in heights:
+        return None
+    return min(heights)
+
+
+# number of reorganizations whose block is kept by indexer
+REORG_LOG = 100
+
+
+def record_reorg(db: Database, indexer_id: str, block: int):
+    """Record that the blocks of indexer_id from block were invalidated.
+
+    The indexed block alone doesn't show a reorganization, the indexer can
+    be back at the same block when it's read again. `_reorgs` isn't versioned
+    by apibara, its invalidations don't remove the records.
+    """
+    db["_reorgs"].update_one(
+        {"indexer_id": indexer_id},
+        {"$inc": {"count": 1}, "$push": {"blocks": {"$each": [block], "$slice": -REORG_LOG}}},
+        upsert=True,
+    )
+
+
+def get_reorgs(db: Database, indexer_id: Optional[str] = None) -> Dict[str, dict]:
+    """Reorganizations recorded by indexer_id, by all the indexers of db by default.
+
+    Each indexer has the number of reorganizations and the first invalidated
+    block of the last REORG_LOG ones.
+    """
+    filter = {} if indexer_id is None else {"indexer_id": indexer_id}
+    return {doc["indexer_id"]: doc for doc in db["_reorgs"].find(filter)}
+
+
+read_preferences = ["primary", "primaryPreferred", "secondary", "secondaryPreferred", "nearest"]
+
+
+def with_read_preference(mongo_url: str, mode: str, max_staleness: Optional[int] = None) -> str:
+    """mongo_url with its read preference replaced by mode.
+
+    max_staleness is in seconds, at least 90, and can't be used with primary.
+    """
+    if mode not in read_preferences:
+        raise ValueError(f"Unknown read preference {mode}, expected one of {read_preferences}")
+    parts = urlsplit(mongo_url)
+    options = [
+        (key, value)
+        for key, value in parse_qsl(parts.query)
+        if key.lower() not in ("readpreference", "maxstalenessseconds")
+    ]
+    options.append(("readPreference", mode))
+    if max_staleness is not None and mode != "primary":
+        options.append(("maxStalenessSeconds", str(max_staleness)))
+    # the database name is required before the options
+    path = parts.path or "/"
+    return urlunsplit((parts.scheme, parts.netloc, path, urlencode(options), parts.fragment))
+
+
+def create_indexes(db: Database):
+    """Create the indexes used by the indexer and the GraphQL resolvers."""
+    db["blocks"].create_index([("number", DESCENDING)])
+    db["blocks"].create_index([("timestamp", DESCENDING), ("number", DESCENDING)])
+
+    # used by the batch resolvers
+    for collection in ["lands", "buildings"]:
+        db[collection].create_index(
+            [("land_id", ASCENDING), ("_chain.valid_to", ASCENDING)]
+        )
+
+    db["land_status"].create_index([("land_id", ASCENDING), ("_chain.valid_to", ASCENDING)])
+    db["land_status"].create_index([("_chain.valid_from", ASCENDING)])
+
+    db["owners"].create_index([("owner", ASCENDING), ("_chain.valid_to", ASCENDING)])
+
+    db["activity"].create_index(
+        [
+            ("land_id", ASCENDING),
+            ("granularity", ASCENDING),
+            ("bucket", DESCENDING),
+            ("_chain.valid_to", ASCENDING),
+        ]
+    )
+
+    # used by the refresh of the in-memory copies, see indexer.live
+    for collection in ["lands", "buildings", "tokens"]:
+        db[collection].create_index([("_chain.valid_from", ASCENDING)])
+        db[collection].create_index([("_chain.valid_to", ASCENDING)])
+
+    # used by landAt, see indexer.history
+    for collection in ["map_deltas", "map_checkpoints"]:
+        db[collection].create_index(
+            [("land_id", ASCENDING), ("_chain.valid_from", DESCENDING), ("log_index", DESCENDING)]
+        )
+
+    # used by the incremental export
+    for collection in event_int_fields:
+        db[collection].create_index([("_chain.valid_from", ASCENDING)])
+
+    # keys of the events and of the map history, a replayed event doesn't
+    # store them twice, see indexer.replay. The events stored before the
+    # keys existed have no log_index.
+    for collection in land_event_collections + ["transfers"]:
+        db[collection].create_index(
+            [("transaction_hash", ASCENDING), ("log_index", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"log_index": {"$exists": True}},
+        )
+    for collection in ["map_deltas", "map_checkpoints"]:
+        db[collection].create_index(
+            [("land_id", ASCENDING), ("log_index", ASCENDING), ("_chain.valid_from", ASCENDING)],
+            unique=True,
+        )
+
+    # used by the *Time and *Block resolvers
+    for collection in land_event_collections:
+        db[collection].create_index(
+            [("land_id", ASCENDING), ("_chain.valid_from", ASCENDING)]
+        )
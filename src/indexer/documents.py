@@ -0,0 +1,134 @@
+"""Caches of GraphQL documents: persisted queries and parsed documents."""
+
+import hashlib
+import json
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from graphql import GraphQLError, specified_rules
+from strawberry.extensions import Extension
+from strawberry.schema.execute import parse_document, validate_document
+
+from indexer.metrics import metrics
+
+
+class LRU:
+    def __init__(self, maxsize: int):
+        self._maxsize = maxsize
+        self._items = OrderedDict()
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is not None:
+            self._items.move_to_end(key)
+        return item
+
+    def set(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        if len(self._items) > self._maxsize:
+            self._items.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class DocumentCache:
+    """LRU cache of parsed documents with the result of their validation."""
+
+    def __init__(self, maxsize: int = 1000):
+        self._documents = LRU(maxsize)
+
+    def get(self, query: str, validation_rules):
+        return self._documents.get((query, validation_rules))
+
+    def set(self, query: str, validation_rules, document, errors):
+        self._documents.set((query, validation_rules), (document, errors))
+
+    def warm(self, schema, queries, validation_rules=tuple(specified_rules)):
+        """Parse and validate the queries ahead of their first request."""
+        for query in queries:
+            try:
+                document = parse_document(query)
+            except GraphQLError as e:
+                print(f"Invalid persisted query: {e}")
+                continue
+            errors = validate_document(schema._schema, document, validation_rules)
+            self.set(query, validation_rules, document, tuple(errors))
+
+
+class DocumentCacheExtension(Extension):
+    """Skip parsing and validation of the documents found in the context cache."""
+
+    def on_parsing_start(self):
+        context = self.execution_context
+        if "documents" not in context.context:
+            return
+        cached = context.context["documents"].get(context.query, context.validation_rules)
+        if cached is None:
+            metrics.inc("graphql_document_cache_misses_total")
+            return
+        metrics.inc("graphql_document_cache_hits_total")
+        context.graphql_document, errors = cached
+        context.errors = list(errors)
+
+    def on_validation_end(self):
+        context = self.execution_context
+        if context.graphql_document is None or "documents" not in context.context:
+            return
+        context.context["documents"].set(
+            context.query,
+            context.validation_rules,
+            context.graphql_document,
+            tuple(context.errors or ()),
+        )
+
+
+class PersistedQueryNotFound(Exception):
+    pass
+
+
+class PersistedQueries:
+    """Queries referenced by the sha256 hash of their text.
+
+    The queries of the manifest file are always known. Clients can also
+    register new queries by sending the query text along with its hash, those
+    are kept in a bounded LRU.
+    """
+
+    def __init__(self, manifest: Optional[Dict[str, str]] = None, maxsize: int = 1000):
+        self._manifest = dict(manifest or {})
+        self._registered = LRU(maxsize)
+
+    @classmethod
+    def from_file(cls, path: str, **kwargs) -> "PersistedQueries":
+        with open(path) as f:
+            return cls(json.load(f), **kwargs)
+
+    def queries(self):
+        return self._manifest.values()
+
+    def resolve(self, data: dict) -> dict:
+        """Fill the query of a request referencing a persisted query."""
+        extensions = data.get("extensions") or {}
+        if isinstance(extensions, str):
+            extensions = json.loads(extensions)
+        persisted = extensions.get("persistedQuery")
+        if not persisted:
+            return data
+
+        query_hash = persisted.get("sha256Hash")
+        query = data.get("query")
+        if query:
+            if hashlib.sha256(query.encode()).hexdigest() != query_hash:
+                raise ValueError("provided sha does not match query")
+            if query_hash not in self._manifest:
+                self._registered.set(query_hash, query)
+            return data
+
+        query = self._manifest.get(query_hash) or self._registered.get(query_hash)
+        if query is None:
+            metrics.inc("graphql_persisted_query_misses_total")
+            raise PersistedQueryNotFound()
+        metrics.inc("graphql_persisted_query_hits_total")
+        return {**data, "query": query}
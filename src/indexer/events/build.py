@@ -1,8 +1,16 @@
+from functools import lru_cache
 from typing import List, NamedTuple
 from apibara import Info
 from apibara.model import BlockHeader, StarkNetEvent
 from starknet_py.contract import FunctionCallSerializer, identifier_manager_from_abi
+from indexer.storage import insert_events
+from indexer.state import new_building, set_cell
+from indexer.history import record_cells
+from indexer.live import find_land, update_land
+from indexer.grid import land_buildings_grid
 from indexer.utils import encode_int_as_bytes, uint256_abi
+from indexer.activity import record_activity
+from indexer.replay import applied, event_position
 
 build_abi = {
     "name": "Build",
@@ -20,17 +28,20 @@ build_abi = {
     ],
 }
 
-build_decoder = FunctionCallSerializer(
-    abi=build_abi,
-    identifier_manager=identifier_manager_from_abi([build_abi, uint256_abi]),
-)
+@lru_cache(maxsize=None)
+def get_build_decoder() -> FunctionCallSerializer:
+    return FunctionCallSerializer(
+        abi=build_abi,
+        identifier_manager=identifier_manager_from_abi([build_abi, uint256_abi]),
+    )
 
 def decode_build_event(data: List[bytes]) -> NamedTuple:
     data = [int.from_bytes(b, "big") for b in data]
-    return build_decoder.to_python(data)
+    return get_build_decoder().to_python(data)
 
 async def handle_build_events(info: Info, block: BlockHeader, ev: StarkNetEvent):
     block_time = block.timestamp
+    position = event_position(block.number, ev.log_index)
     print("Build event")
     builds = [
         {
@@ -56,41 +67,33 @@ async def handle_build_events(info: Info, block: BlockHeader, ev: StarkNetEvent)
         }
         for tr in builds
     ]
-    await info.storage.insert_many("build", build_docs)
+    await insert_events(info, "build", block.number, build_docs, ev.log_index)
 
-    building_docs = [
-        {
-            "owner": encode_int_as_bytes(tr["event"].owner),
-            "land_id": encode_int_as_bytes(tr["event"].land_id),
-            "time": encode_int_as_bytes(tr["event"].time),
-            "building_type_id": encode_int_as_bytes(tr["event"].building_type_id),
-            "building_uid": encode_int_as_bytes(tr["event"].building_uid),
-            "block_comp": encode_int_as_bytes(tr["event"].block_comp),
-            "pos_x": encode_int_as_bytes(tr["event"].pos_x),
-            "pos_y": encode_int_as_bytes(tr["event"].pos_y),
-            "transaction_hash": tr["transaction_hash"],
-            "timestamp": block_time,
-            "status": "built",
-            "decay": 0,
-            "active_cycles": 0,
-            "incoming_cycles": 1 if tr["event"].building_type_id > 2 else 0,
-            "last_fuel": tr["event"].time,
-            "updated_at": block_time,
-        }
-        for tr in builds
-    ]
-    await info.storage.insert_many("buildings", building_docs)
+    for tr in builds:
+        await record_activity(
+            info, encode_int_as_bytes(tr["event"].land_id), block_time, {"builds": 1}, position
+        )
+
+    for doc in build_docs:
+        existing = await info.storage.find_one(
+            "buildings", {"land_id": doc["land_id"], "building_uid": doc["building_uid"]}
+        )
+        if not applied(existing, position):
+            await info.storage.insert_one("buildings", dict(new_building(doc), applied_at=position))
 
     # update map block 
     for tr in builds:
-        land = await info.storage.find_one("lands", {"land_id": encode_int_as_bytes(tr["event"].land_id)})
-        if land is not None:
-            land["map"][tr["event"].pos_y - 1][tr["event"].pos_x - 1] = tr["event"].block_comp
-            await info.storage.find_one_and_update(
-                "lands",
-                {"land_id": encode_int_as_bytes(tr["event"].land_id)},
-                {"$set": { 
-                    "map": land["map"], 
-                    "updated_at": block_time 
-                }}
-            )
\ No newline at end of file
+        land = await find_land(info, encode_int_as_bytes(tr["event"].land_id))
+        if land is not None and not applied(land, position):
+            set_cell(land["map"], tr["event"].pos_x, tr["event"].pos_y, tr["event"].block_comp)
+            grid = await land_buildings_grid(info, land)
+            set_cell(grid, tr["event"].pos_x, tr["event"].pos_y, tr["event"].building_uid)
+            history = await record_cells(
+                info, land, ev.log_index, [(tr["event"].pos_x, tr["event"].pos_y)]
+            )
+            await update_land(info, land, {
+                "map": land["map"],
+                "buildings_grid": grid,
+                "updated_at": block_time,
+                **history
+            }, position)
\ No newline at end of file
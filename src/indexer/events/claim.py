@@ -1,8 +1,12 @@
+from functools import lru_cache
 from typing import List, NamedTuple
 from apibara import Info
 from apibara.model import BlockHeader, StarkNetEvent
 from starknet_py.contract import FunctionCallSerializer, identifier_manager_from_abi
+from indexer.storage import insert_events
+from indexer.state import claim_cycles
 from indexer.utils import encode_int_as_bytes, uint256_abi
+from indexer.replay import applied, event_position, not_applied
 
 claim_abi = {
     "name": "Claim",
@@ -17,18 +21,21 @@ claim_abi = {
     ],
 }
 
-claim_decoder = FunctionCallSerializer(
-    abi=claim_abi,
-    identifier_manager=identifier_manager_from_abi([claim_abi, uint256_abi]),
-)
+@lru_cache(maxsize=None)
+def get_claim_decoder() -> FunctionCallSerializer:
+    return FunctionCallSerializer(
+        abi=claim_abi,
+        identifier_manager=identifier_manager_from_abi([claim_abi, uint256_abi]),
+    )
 
 def decode_claim_event(data: List[bytes]) -> NamedTuple:
     data = [int.from_bytes(b, "big") for b in data]
-    return claim_decoder.to_python(data)
+    return get_claim_decoder().to_python(data)
 
 async def handle_claim_events(info: Info, block: BlockHeader, ev: StarkNetEvent):
     print("Claim Production event")
     block_time = block.timestamp
+    position = event_position(block.number, ev.log_index)
     claims = [
         {
             "event": decode_claim_event(ev.data),
@@ -48,7 +55,7 @@ async def handle_claim_events(info: Info, block: BlockHeader, ev: StarkNetEvent)
         }
         for tr in claims
     ]
-    await info.storage.insert_many("claims", claim_docs)
+    await insert_events(info, "claims", block.number, claim_docs, ev.log_index)
     print("    Claim production stored.")
 
     # update buildings cycles
@@ -59,32 +66,13 @@ async def handle_claim_events(info: Info, block: BlockHeader, ev: StarkNetEvent)
 
         if len(results_list) > 0:
             for building in results_list:
-                active_cycles = building["active_cycles"]
-                incoming_cycles = building["incoming_cycles"]
-                last_fuel = building["last_fuel"]
-
-                if incoming_cycles == 0:
-                    active_cycles = 0
-                else:
-                    passed_blocks = tr["event"].block_number - last_fuel
-                    if incoming_cycles <= passed_blocks:
-                        active_cycles = 0
-                        incoming_cycles = 0
-                    else:
-                        active_cycles = 0
-                        incoming_cycles = incoming_cycles - passed_blocks
-                
+                if applied(building, position):
+                    continue
                 await info.storage.find_one_and_update(
                     "buildings",
-                    {
+                    not_applied({
                         "building_uid": building["building_uid"],
                         "land_id": building["land_id"],
-                    },
-                    {"$set": 
-                        {
-                            "active_cycles": active_cycles,
-                            "incoming_cycles": incoming_cycles,
-                            "last_fuel": tr["event"].block_number,
-                        }
-                    }
-                )
\ No newline at end of file
+                    }, position),
+                    {"$set": {**claim_cycles(building, tr["event"].block_number), "applied_at": position}},
+                )
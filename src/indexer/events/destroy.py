@@ -1,8 +1,16 @@
+from functools import lru_cache
 from typing import List, NamedTuple
 from apibara import Info
 from apibara.model import BlockHeader, StarkNetEvent
 from starknet_py.contract import FunctionCallSerializer, identifier_manager_from_abi
+from indexer.storage import insert_events
+from indexer.state import set_cell
+from indexer.history import record_cells
+from indexer.live import find_land, update_land
+from indexer.grid import land_buildings_grid
 from indexer.utils import encode_int_as_bytes, uint256_abi
+from indexer.activity import record_activity
+from indexer.replay import applied, event_position
 
 destroy_abi = {
     "name": "Destroy",
@@ -20,17 +28,20 @@ destroy_abi = {
     ],
 }
 
-destroy_decoder = FunctionCallSerializer(
-    abi=destroy_abi,
-    identifier_manager=identifier_manager_from_abi([destroy_abi, uint256_abi]),
-)
+@lru_cache(maxsize=None)
+def get_destroy_decoder() -> FunctionCallSerializer:
+    return FunctionCallSerializer(
+        abi=destroy_abi,
+        identifier_manager=identifier_manager_from_abi([destroy_abi, uint256_abi]),
+    )
 
 def decode_destroy_event(data: List[bytes]) -> NamedTuple:
     data = [int.from_bytes(b, "big") for b in data]
-    return destroy_decoder.to_python(data)
+    return get_destroy_decoder().to_python(data)
 
 async def handle_destroy_events(info: Info, block: BlockHeader, ev: StarkNetEvent):
     block_time = block.timestamp
+    position = event_position(block.number, ev.log_index)
     print("Destroy event")
     destroys = [
         {
@@ -54,9 +65,14 @@ async def handle_destroy_events(info: Info, block: BlockHeader, ev: StarkNetEven
         }
         for tr in destroys
     ]
-    await info.storage.insert_many("destroy", destroy_docs)
+    await insert_events(info, "destroy", block.number, destroy_docs, ev.log_index)
     print("    Destroy stored.")
 
+    for tr in destroys:
+        await record_activity(
+            info, encode_int_as_bytes(tr["event"].land_id), block_time, {"destroys": 1}, position
+        )
+
     for de in destroys:
         await info.storage.delete_one(
             "buildings",
@@ -68,14 +84,17 @@ async def handle_destroy_events(info: Info, block: BlockHeader, ev: StarkNetEven
         print("    Buildings updated.")
 
         # update map
-        land = await info.storage.find_one("lands", {"land_id": encode_int_as_bytes(de["event"].land_id)})
-        if land is not None:
-            land["map"][de["event"].pos_y - 1][de["event"].pos_x - 1] = 0
-            await info.storage.find_one_and_update(
-                "lands",
-                {"land_id": encode_int_as_bytes(de["event"].land_id)},
-                {"$set": { 
-                    "map": land["map"], 
-                    "updated_at": block_time 
-                }}
-            )
\ No newline at end of file
+        land = await find_land(info, encode_int_as_bytes(de["event"].land_id))
+        if land is not None and not applied(land, position):
+            set_cell(land["map"], de["event"].pos_x, de["event"].pos_y, 0)
+            grid = await land_buildings_grid(info, land)
+            set_cell(grid, de["event"].pos_x, de["event"].pos_y, 0)
+            history = await record_cells(
+                info, land, ev.log_index, [(de["event"].pos_x, de["event"].pos_y)]
+            )
+            await update_land(info, land, {
+                "map": land["map"],
+                "buildings_grid": grid,
+                "updated_at": block_time,
+                **history
+            }, position)
\ No newline at end of file
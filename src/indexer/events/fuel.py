@@ -1,8 +1,13 @@
+from functools import lru_cache
 from typing import List, NamedTuple
 from apibara import Info
 from apibara.model import BlockHeader, StarkNetEvent
 from starknet_py.contract import FunctionCallSerializer, identifier_manager_from_abi
+from indexer.storage import insert_events
+from indexer.state import fuel_cycles
 from indexer.utils import encode_int_as_bytes, uint256_abi
+from indexer.activity import record_activity
+from indexer.replay import applied, event_position, not_applied
 
 fuel_abi = {
     "name": "FuelProduction",
@@ -20,18 +25,21 @@ fuel_abi = {
     ],
 }
 
-fuel_decoder = FunctionCallSerializer(
-    abi=fuel_abi,
-    identifier_manager=identifier_manager_from_abi([fuel_abi, uint256_abi]),
-)
+@lru_cache(maxsize=None)
+def get_fuel_decoder() -> FunctionCallSerializer:
+    return FunctionCallSerializer(
+        abi=fuel_abi,
+        identifier_manager=identifier_manager_from_abi([fuel_abi, uint256_abi]),
+    )
 
 def decode_fuel_event(data: List[bytes]) -> NamedTuple:
     data = [int.from_bytes(b, "big") for b in data]
-    return fuel_decoder.to_python(data)
+    return get_fuel_decoder().to_python(data)
 
 async def handle_fuel_events(info: Info, block: BlockHeader, ev: StarkNetEvent):
     print("Fuel Production event")
     block_time = block.timestamp
+    position = event_position(block.number, ev.log_index)
 
     fuels = [
         {
@@ -55,41 +63,33 @@ async def handle_fuel_events(info: Info, block: BlockHeader, ev: StarkNetEvent):
         }
         for tr in fuels
     ]
-    await info.storage.insert_many("fuel", fuel_docs)
+    await insert_events(info, "fuel", block.number, fuel_docs, ev.log_index)
     print("    Fuel production stored.")
 
+    for tr in fuels:
+        await record_activity(
+            info,
+            encode_int_as_bytes(tr["event"].land_id),
+            block_time,
+            {f"fuel.{tr['event'].building_type_id}": tr["event"].nb_blocks},
+            position,
+        )
+
     for de in fuels:
         building = await info.storage.find_one("buildings", {
             "building_uid": encode_int_as_bytes(de["event"].building_uid), 
             "land_id": encode_int_as_bytes(de["event"].land_id)
         })
-        if building is not None:
-            active_cycles = building["active_cycles"]
-            incoming_cycles = building["incoming_cycles"]
-            last_fuel = building["last_fuel"]
-
-            if incoming_cycles == 0:
-                incoming_cycles = de["event"].nb_blocks
-            else:
-                passed_blocks = de["event"].time - last_fuel
-                print("passed_blocks", passed_blocks)
-                if incoming_cycles <= passed_blocks:
-                    active_cycles += incoming_cycles
-                    incoming_cycles = de["event"].nb_blocks
-                else:
-                    active_cycles += passed_blocks
-                    incoming_cycles = incoming_cycles - passed_blocks + de["event"].nb_blocks
-            
+        if building is not None and not applied(building, position):
             await info.storage.find_one_and_update(
                 "buildings",
-                {
+                not_applied({
                     "building_uid": encode_int_as_bytes(de["event"].building_uid),
                     "land_id": encode_int_as_bytes(de["event"].land_id),
-                },
+                }, position),
                 {"$set": {
-                    "active_cycles": active_cycles,
-                    "incoming_cycles": incoming_cycles,
-                    "last_fuel": de["event"].time,
+                    **fuel_cycles(building, de["event"].time, de["event"].nb_blocks),
+                    "applied_at": position,
                 }},
             )
     print("    Buildings updated with fuels.")
\ No newline at end of file
@@ -1,8 +1,15 @@
+from functools import lru_cache
 from typing import List, NamedTuple
 from apibara import Info
 from apibara.model import BlockHeader, StarkNetEvent
 from starknet_py.contract import FunctionCallSerializer, identifier_manager_from_abi
+from indexer.storage import insert_events
+from indexer.state import set_cell
+from indexer.history import record_cells
+from indexer.live import find_land, update_land
 from indexer.utils import encode_int_as_bytes, uint256_abi
+from indexer.activity import record_activity
+from indexer.replay import applied, event_position
 
 harvest_abi = {
     "name": "HarvestResource",
@@ -20,17 +27,20 @@ harvest_abi = {
     ],
 }
 
-harvest_decoder = FunctionCallSerializer(
-    abi=harvest_abi,
-    identifier_manager=identifier_manager_from_abi([harvest_abi, uint256_abi]),
-)
+@lru_cache(maxsize=None)
+def get_harvest_decoder() -> FunctionCallSerializer:
+    return FunctionCallSerializer(
+        abi=harvest_abi,
+        identifier_manager=identifier_manager_from_abi([harvest_abi, uint256_abi]),
+    )
 
 def decode_harvest_event(data: List[bytes]) -> NamedTuple:
     data = [int.from_bytes(b, "big") for b in data]
-    return harvest_decoder.to_python(data)
+    return get_harvest_decoder().to_python(data)
 
 async def handle_harvest_events(info: Info, block: BlockHeader, ev: StarkNetEvent):
     block_time = block.timestamp
+    position = event_position(block.number, ev.log_index)
     harvests = [
         {
             "event": decode_harvest_event(ev.data),
@@ -53,19 +63,28 @@ async def handle_harvest_events(info: Info, block: BlockHeader, ev: StarkNetEven
         }
         for tr in harvests
     ]
-    await info.storage.insert_many("harvest", harvest_docs)
+    await insert_events(info, "harvest", block.number, harvest_docs, ev.log_index)
     print("    Harvests stored.")
 
+    for tr in harvests:
+        await record_activity(
+            info,
+            encode_int_as_bytes(tr["event"].land_id),
+            block_time,
+            {f"harvest.{tr['event'].resource_type}": 1},
+            position,
+        )
+
     # Update map block
     for tr in harvests:
-        land = await info.storage.find_one("lands", {"land_id": encode_int_as_bytes(tr["event"].land_id)})
-        if land is not None:
-            land["map"][tr["event"].pos_y - 1][tr["event"].pos_x - 1] = tr["event"].block_comp
-            await info.storage.find_one_and_update(
-                "lands",
-                {"land_id": encode_int_as_bytes(tr["event"].land_id)},
-                {"$set": { 
-                    "map": land["map"],
-                    "updated_at": block_time 
-                }}
-            )
\ No newline at end of file
+        land = await find_land(info, encode_int_as_bytes(tr["event"].land_id))
+        if land is not None and not applied(land, position):
+            set_cell(land["map"], tr["event"].pos_x, tr["event"].pos_y, tr["event"].block_comp)
+            history = await record_cells(
+                info, land, ev.log_index, [(tr["event"].pos_x, tr["event"].pos_y)]
+            )
+            await update_land(info, land, {
+                "map": land["map"],
+                "updated_at": block_time,
+                **history
+            }, position)
\ No newline at end of file
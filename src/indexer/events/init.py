@@ -1,8 +1,17 @@
+from functools import lru_cache
 from typing import List, NamedTuple
 from apibara import Info
 from apibara.model import BlockHeader, StarkNetEvent
 from starknet_py.contract import FunctionCallSerializer, identifier_manager_from_abi
-from indexer.utils import encode_int_as_bytes, uint256_abi, create_map_array
+from indexer.utils import encode_int_as_bytes, uint256_abi
+from indexer.state import new_cabin, new_land
+from indexer.history import record_checkpoint
+from indexer.live import find_land, insert_land
+from indexer.status import update_land_status
+from indexer.owners import add_to_owner
+from indexer.replay import applied, event_position, not_applied
+from indexer.shards import handles_tokens
+from indexer.storage import insert_events
 
 newGame_abi = {
     "name": "NewGame",
@@ -15,18 +24,21 @@ newGame_abi = {
     ],
 }
 
-newGame_decoder = FunctionCallSerializer(
-    abi=newGame_abi,
-    identifier_manager=identifier_manager_from_abi([newGame_abi, uint256_abi]),
-)
+@lru_cache(maxsize=None)
+def get_newGame_decoder() -> FunctionCallSerializer:
+    return FunctionCallSerializer(
+        abi=newGame_abi,
+        identifier_manager=identifier_manager_from_abi([newGame_abi, uint256_abi]),
+    )
 
 def decode_new_game_event(data: List[bytes]) -> NamedTuple:
     data = [int.from_bytes(b, "big") for b in data]
-    return newGame_decoder.to_python(data)
+    return get_newGame_decoder().to_python(data)
 
 async def handle_init_events(info: Info, block: BlockHeader, ev: StarkNetEvent):
     print("NewGame event")
     block_time = block.timestamp
+    position = event_position(block.number, ev.log_index)
     inits = [
         {
             "event": decode_new_game_event(ev.data),
@@ -46,47 +58,75 @@ async def handle_init_events(info: Info, block: BlockHeader, ev: StarkNetEvent):
         for tr in inits
     ]
 
-    await info.storage.insert_many("inits", init_docs)
+    await insert_events(info, "inits", block.number, init_docs, ev.log_index)
     print("    Inits stored.")
 
+    for ini in inits:
+        await update_land_status(
+            info,
+            encode_int_as_bytes(ini["event"].land_id),
+            encode_int_as_bytes(ini["event"].owner),
+            block_time,
+            position,
+        )
+        # on the shard of the tokens when the indexer is sharded
+        if handles_tokens(info.context):
+            await add_to_owner(
+                info,
+                encode_int_as_bytes(ini["event"].owner),
+                block_time,
+                position,
+                land_ids=[encode_int_as_bytes(ini["event"].land_id)],
+            )
+
     cabins = [
-        {
-            "owner": encode_int_as_bytes(ca["event"].owner),
-            "land_id": encode_int_as_bytes(ca["event"].land_id),
-            "time": encode_int_as_bytes(ca["event"].time),
-            "building_type_id": encode_int_as_bytes(1),
-            "building_uid": encode_int_as_bytes(1),
-            "block_comp": encode_int_as_bytes(20100011199),
-            "pos_x": encode_int_as_bytes(20),
-            "pos_y": encode_int_as_bytes(8),
-            "transaction_hash": ca["transaction_hash"],
-            "timestamp": block_time,
-            "status": "built",
-            "decay": 100,
-            "active_cycles": 0,
-            "incoming_cycles": 0,
-            "last_fuel": ca["event"].time,
-            "updated_at": block_time,
-        }
+        new_cabin(
+            encode_int_as_bytes(ca["event"].owner),
+            encode_int_as_bytes(ca["event"].land_id),
+            encode_int_as_bytes(ca["event"].time),
+            ca["event"].time,
+            ca["transaction_hash"],
+            block_time,
+        )
         for ca in inits
     ]
-    await info.storage.insert_many("buildings", cabins)
+    for cabin in cabins:
+        existing = await info.storage.find_one(
+            "buildings", {"land_id": cabin["land_id"], "building_uid": cabin["building_uid"]}
+        )
+        if not applied(existing, position):
+            await info.storage.insert_one("buildings", dict(cabin, applied_at=position))
     print("    Cabin stored.")    
 
-    # create map
+    # create map, the land is stored last and marks the event as applied
     for ini in inits:
-        map = create_map_array()
-        await info.storage.insert_one("lands", {
-            "map": map, 
-            "land_id": encode_int_as_bytes(ini["event"].land_id), 
-            "transaction_hash": ini["transaction_hash"],
-            "time": encode_int_as_bytes(ini["event"].time),
-            "timestamp": block_time, 
-            "updated_at": block_time,
-        })
+        land = new_land(
+            encode_int_as_bytes(ini["event"].land_id),
+            encode_int_as_bytes(ini["event"].time),
+            ini["transaction_hash"],
+            block_time,
+        )
+        if applied(await find_land(info, land["land_id"]), position):
+            continue
+        await record_checkpoint(info, land["land_id"], land["map"], ev.log_index, "init")
+        await insert_land(info, land, position)
         print("    Initialized lands.")
 
 
+# The owners index part of NewGame, on the shard of the tokens when another
+# shard applies the event.
+async def handle_init_owner_events(info: Info, block: BlockHeader, ev: StarkNetEvent):
+    event = decode_new_game_event(ev.data)
+    await add_to_owner(
+        info,
+        encode_int_as_bytes(event.owner),
+        block.timestamp,
+        event_position(block.number, ev.log_index),
+        land_ids=[encode_int_as_bytes(event.land_id)],
+    )
+    print("    Owners index updated.")
+
+
 reset_abi = {
     "name": "ResetGame",
     "type": "event",
@@ -98,17 +138,20 @@ reset_abi = {
     ],
 }
 
-reset_decoder = FunctionCallSerializer(
-    abi=reset_abi,
-    identifier_manager=identifier_manager_from_abi([reset_abi, uint256_abi]),
-)
+@lru_cache(maxsize=None)
+def get_reset_decoder() -> FunctionCallSerializer:
+    return FunctionCallSerializer(
+        abi=reset_abi,
+        identifier_manager=identifier_manager_from_abi([reset_abi, uint256_abi]),
+    )
 
 def decode_reset_event(data: List[bytes]) -> NamedTuple:
     data = [int.from_bytes(b, "big") for b in data]
-    return reset_decoder.to_python(data)
+    return get_reset_decoder().to_python(data)
 
 async def handle_reset_events(info: Info, block: BlockHeader, ev: StarkNetEvent):
     block_time = block.timestamp
+    position = event_position(block.number, ev.log_index)
     print("Reset event")
     resets = [
         {
@@ -128,52 +171,54 @@ async def handle_reset_events(info: Info, block: BlockHeader, ev: StarkNetEvent)
         }
         for tr in resets
     ]
-    await info.storage.insert_many("resets", reset_docs)
+    await insert_events(info, "resets", block.number, reset_docs, ev.log_index)
+
+    for tr in resets:
+        await update_land_status(
+            info,
+            encode_int_as_bytes(tr["event"].land_id),
+            encode_int_as_bytes(tr["event"].owner),
+            block_time,
+            position,
+            reset_block=block.number,
+        )
 
     # Delete all buildings that are not cabin
     for tr in resets:
+        land_id = encode_int_as_bytes(tr["event"].land_id)
+        # the new land is stored last and marks the event as applied
+        if applied(await find_land(info, land_id), position):
+            continue
         await info.storage.delete_many(
             "buildings",
-            { "land_id": encode_int_as_bytes(tr["event"].land_id)},
+            not_applied({"land_id": land_id}, position),
         )
 
         # Update decay cabin
-        await info.storage.insert_one(
-            "buildings",
-            {
-                "owner": encode_int_as_bytes(tr["event"].owner),
-                "land_id": encode_int_as_bytes(tr["event"].land_id),
-                "time": encode_int_as_bytes(block.number),
-                "building_type_id": encode_int_as_bytes(1),
-                "building_uid": encode_int_as_bytes(1),
-                "block_comp": encode_int_as_bytes(20100011199),
-                "pos_x": encode_int_as_bytes(20),
-                "pos_y": encode_int_as_bytes(8),
-                "transaction_hash": tr["transaction_hash"],
-                "timestamp": block_time,
-                "status": "built",
-                "decay": 100,
-                "active_cycles": 0,
-                "incoming_cycles": 0,
-                "last_fuel": block.number,
-                "updated_at": block_time,
-            },
+        cabin = new_cabin(
+            encode_int_as_bytes(tr["event"].owner),
+            land_id,
+            encode_int_as_bytes(block.number),
+            block.number,
+            tr["transaction_hash"],
+            block_time,
+        )
+        existing = await info.storage.find_one(
+            "buildings", {"land_id": land_id, "building_uid": cabin["building_uid"]}
         )
+        if not applied(existing, position):
+            await info.storage.insert_one("buildings", dict(cabin, applied_at=position))
 
         # Reset map
-        map = create_map_array()
+        land = new_land(
+            land_id,
+            encode_int_as_bytes(block.number),
+            tr["transaction_hash"],
+            block_time,
+        )
+        await record_checkpoint(info, land["land_id"], land["map"], ev.log_index, "reset")
         await info.storage.delete_one(
             "lands",
-            {"land_id": encode_int_as_bytes(tr["event"].land_id)}
+            not_applied({"land_id": land_id}, position)
         )
-        await info.storage.insert_one(
-            "lands",
-            {
-                "map": map, 
-                "land_id": encode_int_as_bytes(tr["event"].land_id), 
-                "transaction_hash": tr["transaction_hash"],
-                "time": encode_int_as_bytes(block.number),
-                "timestamp": block_time, 
-                "updated_at": block_time,
-            },
-        )
\ No newline at end of file
+        await insert_land(info, land, position)
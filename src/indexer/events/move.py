@@ -1,8 +1,15 @@
+from functools import lru_cache
 from typing import List, NamedTuple
 from apibara import Info
 from apibara.model import BlockHeader, StarkNetEvent
 from starknet_py.contract import FunctionCallSerializer, identifier_manager_from_abi
+from indexer.storage import insert_events
+from indexer.state import move_cell, set_cell
+from indexer.history import record_cells
+from indexer.live import find_land, update_land
+from indexer.grid import land_buildings_grid
 from indexer.utils import encode_int_as_bytes, uint256_abi
+from indexer.replay import applied, event_position, not_applied
 
 move_abi = {
     "name": "Move",
@@ -22,18 +29,21 @@ move_abi = {
     ],
 }
 
-move_decoder = FunctionCallSerializer(
-    abi=move_abi,
-    identifier_manager=identifier_manager_from_abi([move_abi, uint256_abi]),
-)
+@lru_cache(maxsize=None)
+def get_move_decoder() -> FunctionCallSerializer:
+    return FunctionCallSerializer(
+        abi=move_abi,
+        identifier_manager=identifier_manager_from_abi([move_abi, uint256_abi]),
+    )
 
 def decode_move_event(data: List[bytes]) -> NamedTuple:
     data = [int.from_bytes(b, "big") for b in data]
-    return move_decoder.to_python(data)
+    return get_move_decoder().to_python(data)
 
 async def handle_move_events(info: Info, block: BlockHeader, ev: StarkNetEvent):
     print("Move event")
     block_time = block.timestamp
+    position = event_position(block.number, ev.log_index)
     moves = [
         {
             "event": decode_move_event(ev.data),
@@ -58,35 +68,50 @@ async def handle_move_events(info: Info, block: BlockHeader, ev: StarkNetEvent):
         }
         for tr in moves
     ]
-    await info.storage.insert_many("moves", move_docs)
+    await insert_events(info, "moves", block.number, move_docs, ev.log_index)
     print("    Move stored.")
 
     for tr in moves:
         await info.storage.find_one_and_update(
             "buildings",
-            {
-                "building_uid": encode_int_as_bytes(tr["event"].building_uid),
+            not_applied({
+                "building_uid": encode_int_as_bytes(tr["event"].infra_uid),
                 "land_id": encode_int_as_bytes(tr["event"].land_id),
-            },
+            }, position),
             {"$set": {
                 "pos_x": encode_int_as_bytes(tr["event"].new_pos_x),
                 "pos_y": encode_int_as_bytes(tr["event"].new_pos_y),
                 "updated_at": block_time,
+                "applied_at": position,
             }}
         )
         print("    Buildings updated with new position.")
 
         # * Update map block
-        land = await info.storage.find_one("lands", {"land_id": encode_int_as_bytes(tr["event"].land_id)})
-        if land is not None:
-            new_block = land["map"][tr["event"].pos_y][tr["event"].pos_x]
-            land["map"][tr["event"].new_pos_y - 1][tr["event"].new_pos_x - 1] = new_block
-            land["map"][tr["event"].pos_y - 1][tr["event"].pos_x - 1] = 0
-            await info.storage.find_one_and_update(
-                "lands",
-                {"land_id": encode_int_as_bytes(tr["event"].land_id)},
-                {"$set": { 
-                    "map": land["map"], 
-                    "updated_at": block_time 
-                }}
-            )
\ No newline at end of file
+        land = await find_land(info, encode_int_as_bytes(tr["event"].land_id))
+        if land is not None and not applied(land, position):
+            move_cell(
+                land["map"],
+                tr["event"].pos_x,
+                tr["event"].pos_y,
+                tr["event"].new_pos_x,
+                tr["event"].new_pos_y,
+            )
+            grid = await land_buildings_grid(info, land)
+            set_cell(grid, tr["event"].pos_x, tr["event"].pos_y, 0)
+            set_cell(grid, tr["event"].new_pos_x, tr["event"].new_pos_y, tr["event"].infra_uid)
+            history = await record_cells(
+                info,
+                land,
+                ev.log_index,
+                [
+                    (tr["event"].new_pos_x, tr["event"].new_pos_y),
+                    (tr["event"].pos_x, tr["event"].pos_y),
+                ],
+            )
+            await update_land(info, land, {
+                "map": land["map"],
+                "buildings_grid": grid,
+                "updated_at": block_time,
+                **history
+            }, position)
\ No newline at end of file
@@ -1,8 +1,11 @@
+from functools import lru_cache
 from typing import List, NamedTuple
 from apibara import Info
 from apibara.model import BlockHeader, StarkNetEvent
 from starknet_py.contract import FunctionCallSerializer, identifier_manager_from_abi
+from indexer.storage import insert_events
 from indexer.utils import encode_int_as_bytes, uint256_abi
+from indexer.replay import event_position, not_applied
 
 repair_abi = {
     "name": "Repair",
@@ -19,18 +22,21 @@ repair_abi = {
     ],
 }
 
-repair_decoder = FunctionCallSerializer(
-    abi=repair_abi,
-    identifier_manager=identifier_manager_from_abi([repair_abi, uint256_abi]),
-)
+@lru_cache(maxsize=None)
+def get_repair_decoder() -> FunctionCallSerializer:
+    return FunctionCallSerializer(
+        abi=repair_abi,
+        identifier_manager=identifier_manager_from_abi([repair_abi, uint256_abi]),
+    )
 
 def decode_repair_event(data: List[bytes]) -> NamedTuple:
     data = [int.from_bytes(b, "big") for b in data]
-    return repair_decoder.to_python(data)
+    return get_repair_decoder().to_python(data)
 
 async def handle_repair_events(info: Info, block: BlockHeader, ev: StarkNetEvent):
     print("Repair event")
     block_time = block.timestamp
+    position = event_position(block.number, ev.log_index)
     repairs = [
         {
             "event": decode_repair_event(ev.data),
@@ -52,16 +58,16 @@ async def handle_repair_events(info: Info, block: BlockHeader, ev: StarkNetEvent
         }
         for tr in repairs
     ]
-    await info.storage.insert_many("repairs", repair_docs)
+    await insert_events(info, "repairs", block.number, repair_docs, ev.log_index)
     print("    Repairs stored.")
 
     # update cabin in buildings 
     for tr in repairs:
         await info.storage.find_one_and_update(
             "buildings",
-            {
+            not_applied({
                 "building_uid": encode_int_as_bytes(tr["event"].building_uid), 
                 "land_id": encode_int_as_bytes(tr["event"].land_id)
-            },
-            {"$set": {"decay": 0, "updated_at": block_time}},
+            }, position),
+            {"$set": {"decay": 0, "updated_at": block_time, "applied_at": position}},
         )
\ No newline at end of file
@@ -1,8 +1,12 @@
+from functools import lru_cache
 from typing import List, NamedTuple
 from apibara import Info
 from apibara.model import BlockHeader, StarkNetEvent
 from starknet_py.contract import FunctionCallSerializer, identifier_manager_from_abi
+from indexer.storage import insert_events
 from indexer.utils import encode_int_as_bytes, uint256_abi
+from indexer.owners import add_to_owner, owns_land, remove_from_owner
+from indexer.replay import applied, event_position
 
 transfer_abi = {
     "name": "Transfer",
@@ -15,18 +19,21 @@ transfer_abi = {
     ],
 }
 
-transfer_decoder = FunctionCallSerializer(
-    abi=transfer_abi,
-    identifier_manager=identifier_manager_from_abi([transfer_abi, uint256_abi]),
-)
+@lru_cache(maxsize=None)
+def get_transfer_decoder() -> FunctionCallSerializer:
+    return FunctionCallSerializer(
+        abi=transfer_abi,
+        identifier_manager=identifier_manager_from_abi([transfer_abi, uint256_abi]),
+    )
 
 def decode_transfer_event(data: List[bytes]) -> NamedTuple:
     data = [int.from_bytes(b, "big") for b in data]
-    return transfer_decoder.to_python(data)
+    return get_transfer_decoder().to_python(data)
 
 async def handle_transfer_events(info: Info, block: BlockHeader, ev: StarkNetEvent):
     print("Transfer event")
     block_time = block.timestamp
+    position = event_position(block.number, ev.log_index)
     transfers = [
         {
             "event": decode_transfer_event(ev.data),
@@ -48,7 +55,7 @@ async def handle_transfer_events(info: Info, block: BlockHeader, ev: StarkNetEve
     ]
 
     # Now store to the database.
-    await info.storage.insert_many("transfers", transfers_docs)
+    await insert_events(info, "transfers", block.number, transfers_docs, ev.log_index)
     print("    Transfers stored.")
 
     new_token_owner = dict()
@@ -57,6 +64,9 @@ async def handle_transfer_events(info: Info, block: BlockHeader, ev: StarkNetEve
 
     for token_id, new_owner in new_token_owner.items():
         token_id = encode_int_as_bytes(token_id)
+        existing = await info.storage.find_one("tokens", {"token_id": token_id})
+        if applied(existing, position):
+            continue
         # Use upsert to store the token if it's the first
         # time indexing it.
         await info.storage.find_one_and_replace(
@@ -66,7 +76,29 @@ async def handle_transfer_events(info: Info, block: BlockHeader, ev: StarkNetEve
                 "token_id": token_id,
                 "owner": encode_int_as_bytes(new_owner),
                 "updated_at": block_time,
+                "applied_at": position,
             },
             upsert=True,
         )
-    print("    Owners updated.")
\ No newline at end of file
+    print("    Owners updated.")
+
+    # Update the owners index, lands follow their token. The new owner is
+    # updated first: until it has the token, the previous owner still has it
+    # when the event is handled again.
+    for transfer in transfers:
+        token_id = encode_int_as_bytes(transfer["event"].token_id)
+        from_address = encode_int_as_bytes(transfer["event"].from_address)
+        to_address = encode_int_as_bytes(transfer["event"].to_address)
+        if from_address == to_address:
+            continue
+        is_land = await owns_land(info, from_address, token_id)
+        await add_to_owner(
+            info,
+            to_address,
+            block_time,
+            position,
+            token_ids=[token_id],
+            land_ids=[token_id] if is_land else [],
+        )
+        await remove_from_owner(info, from_address, block_time, position, token_id)
+    print("    Owners index updated.")
\ No newline at end of file
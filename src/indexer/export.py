@@ -0,0 +1,185 @@
+"""Export of the event collections to Parquet files."""
+
+import json
+import os
+from typing import Dict, List, Optional
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pymongo.database import Database
+
+from indexer.db import event_int_fields, get_indexed_to
+from indexer.storage import find_events
+
+# felt fields of each exported collection, decoded to integer columns
+export_fields = event_int_fields
+
+# addresses and hashes don't fit in 64 bits, they are kept as 32 bytes
+export_address_fields = {
+    "harvest": ["owner"],
+    "fuel": ["owner"],
+    "build": ["owner"],
+    "moves": ["owner"],
+    "repairs": ["owner"],
+    "destroy": ["owner"],
+    "claims": ["owner"],
+    "transfers": ["from_address", "to_address", "token_id"],
+}
+
+
+def export_schema(collection: str) -> pa.Schema:
+    fields = [pa.field("block", pa.uint64()), pa.field("timestamp", pa.timestamp("ms"))]
+    fields += [pa.field(name, pa.uint64()) for name in export_fields[collection]]
+    fields += [pa.field(name, pa.binary(32)) for name in export_address_fields[collection]]
+    fields += [pa.field("transaction_hash", pa.binary())]
+    return pa.schema(fields)
+
+
+class PartitionWriter:
+    """Write the rows of a collection to one file per block range.
+
+    Rows are buffered in columns and written as a row group every
+    `batch_size` rows, so memory usage doesn't depend on the collection size.
+    """
+
+    def __init__(self, output_dir: str, collection: str, partition_blocks: int, from_block: int, batch_size: int):
+        self._output_dir = output_dir
+        self._collection = collection
+        self._partition_blocks = partition_blocks
+        self._from_block = from_block
+        self._batch_size = batch_size
+        self._schema = export_schema(collection)
+        self._columns = {name: [] for name in self._schema.names}
+        self._rows = 0
+        self._partition = None
+        self._writer = None
+        self._path = None
+        self.files = []
+
+    def write(self, doc: dict):
+        block = doc["_chain"]["valid_from"]
+        partition = block // self._partition_blocks
+        if partition != self._partition:
+            self._close_partition()
+            self._partition = partition
+
+        self._columns["block"].append(block)
+        self._columns["timestamp"].append(doc["timestamp"])
+        for name in export_fields[self._collection]:
+            self._columns[name].append(int.from_bytes(doc[name], "big"))
+        for name in export_address_fields[self._collection]:
+            self._columns[name].append(doc[name])
+        self._columns["transaction_hash"].append(doc["transaction_hash"])
+        self._rows += 1
+        if self._rows >= self._batch_size:
+            self._flush()
+
+    def close(self):
+        self._close_partition()
+
+    def _flush(self):
+        if self._rows == 0:
+            return
+        if self._writer is None:
+            start = self._partition * self._partition_blocks
+            end = start + self._partition_blocks - 1
+            directory = os.path.join(self._output_dir, self._collection, f"blocks={start}-{end}")
+            os.makedirs(directory, exist_ok=True)
+            # one file per export run and partition, a failed run is overwritten
+            self._path = os.path.join(directory, f"from-{self._from_block}.parquet")
+            self._writer = pq.ParquetWriter(self._path + ".tmp", self._schema, compression="zstd")
+        table = pa.Table.from_pydict(self._columns, schema=self._schema)
+        self._writer.write_table(table)
+        self._columns = {name: [] for name in self._schema.names}
+        self._rows = 0
+
+    def _close_partition(self):
+        self._flush()
+        if self._writer is not None:
+            self._writer.close()
+            os.replace(self._path + ".tmp", self._path)
+            self.files.append(self._path)
+        self._writer = None
+        self._path = None
+
+
+def read_state(output_dir: str) -> Dict[str, int]:
+    path = os.path.join(output_dir, "_state.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_state(output_dir: str, state: Dict[str, int]):
+    path = os.path.join(output_dir, "_state.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def export_collection(
+    db: Database,
+    collection: str,
+    output_dir: str,
+    from_block: int,
+    to_block: int,
+    batch_size: int = 50_000,
+    partition_blocks: int = 10_000,
+) -> PartitionWriter:
+    """Export the documents of collection indexed in ]from_block, to_block]."""
+    projection = ["_chain.valid_from", "timestamp", "transaction_hash"]
+    projection += export_fields[collection] + export_address_fields[collection]
+    cursor = find_events(
+        db,
+        collection,
+        {
+            "_chain.valid_to": None,
+            "_chain.valid_from": {"$gt": from_block, "$lte": to_block},
+        },
+        [("_chain.valid_from", 1)],
+        projection={name: 1 for name in projection},
+        batch_size=batch_size,
+    )
+
+    writer = PartitionWriter(output_dir, collection, partition_blocks, from_block + 1, batch_size)
+    try:
+        for doc in cursor:
+            writer.write(doc)
+    finally:
+        cursor.close()
+    writer.close()
+    return writer
+
+
+def run_export(
+    db: Database,
+    output_dir: str,
+    collections: Optional[List[str]] = None,
+    batch_size: int = 50_000,
+    partition_blocks: int = 10_000,
+):
+    if not collections:
+        collections = list(export_fields)
+
+    to_block = get_indexed_to(db)
+    if to_block is None:
+        print("Nothing indexed yet.")
+        return
+
+    os.makedirs(output_dir, exist_ok=True)
+    exported = read_state(output_dir)
+    for collection in collections:
+        if collection not in export_fields:
+            raise ValueError(f"Cannot export {collection}, expected one of {list(export_fields)}")
+        from_block = exported.get(collection, -1)
+        if from_block >= to_block:
+            print(f"{collection}: up to date at block {from_block}")
+            continue
+
+        writer = export_collection(
+            db, collection, output_dir, from_block, to_block, batch_size, partition_blocks
+        )
+        exported[collection] = to_block
+        write_state(output_dir, exported)
+        print(f"{collection}: exported blocks {from_block + 1} to {to_block} in {len(writer.files)} files")
@@ -0,0 +1,107 @@
+"""Game instances indexed over one Apibara stream.
+
+Each instance of `config.get_games()` (a deployment or a season of the game) has
+the address of its map and Frenslands contracts and a namespace. The events
+of all the instances are streamed together, each event is routed by its
+contract address to the handlers of its instances.
+
+The documents of an instance are stored in the collections of the indexer
+database prefixed by its namespace, e.g. `season2_lands`. An empty namespace
+keeps the collections unprefixed. The apibara state and the block headers
+are shared by the instances.
+
+The GraphQL server imports this module, the routing of the events (with
+apibara) is in `indexer.router`.
+"""
+
+from typing import List, Optional, Tuple
+
+from pymongo.database import Database
+
+from indexer.config import get_games
+
+# events of each contract of an instance
+map_events = ["Transfer"]
+frenslands_events = [
+    "NewGame",
+    "HarvestResource",
+    "Destroy",
+    "Build",
+    "Repair",
+    "Move",
+    "FuelProduction",
+    "Claim",
+    "ResetGame",
+]
+
+# collections shared by the instances
+shared_collections = ["blocks"]
+
+
+def collection_name(namespace: str, name: str) -> str:
+    if not namespace or name.startswith("_") or name in shared_collections:
+        return name
+    return f"{namespace}_{name}"
+
+
+class GameDatabase:
+    """The collections of the instance with namespace in db."""
+
+    def __init__(self, db: Database, namespace: str):
+        self.db = db
+        self.namespace = namespace
+
+    def __getitem__(self, name: str):
+        return self.db[collection_name(self.namespace, name)]
+
+    def __getattr__(self, name: str):
+        if hasattr(Database, name):
+            return getattr(self.db, name)
+        return self[name]
+
+
+class GameStorage:
+    """The apibara storage of a block, on the collections of the instance with namespace."""
+
+    def __init__(self, storage, namespace: str):
+        self.storage = storage
+        self.namespace = namespace
+
+    def __getattr__(self, name: str):
+        method = getattr(self.storage, name)
+
+        async def call(collection: str, *args, **kwargs):
+            return await method(collection_name(self.namespace, collection), *args, **kwargs)
+
+        return call
+
+
+def game_database(db: Database, namespace: str):
+    return GameDatabase(db, namespace) if namespace else db
+
+
+def find_game(name: Optional[str]) -> dict:
+    """The instance named name, the first one when name is None."""
+    games = get_games()
+    if name is None:
+        return games[0]
+    for game in games:
+        if game["name"] == name:
+            return game
+    raise ValueError(f"Unknown game {name}, expected one of {[game['name'] for game in games]}")
+
+
+def check_games():
+    namespaces = [game["namespace"] for game in get_games()]
+    if len(set(namespaces)) != len(namespaces):
+        raise ValueError("The namespaces of the games must be different")
+    for namespace in namespaces:
+        # apibara doesn't invalidate the collections starting with _
+        if namespace.startswith("_"):
+            raise ValueError(f"Invalid namespace {namespace}, it can't start with _")
+
+
+def game_events(game: dict) -> List[Tuple[str, str]]:
+    return [(name, game["map_address"]) for name in map_events] + [
+        (name, game["frenslands_address"]) for name in frenslands_events
+    ]
@@ -0,0 +1,70 @@
+"""Spatial index of the buildings of the lands.
+
+The `buildings_grid` of a land document is aligned with its map and has the
+uid of the building on each cell, 0 on the cells without building. The
+handlers update it with the map, so the content of a cell or of a rectangle
+is read from the land document and the buildings it references, without
+scanning the buildings of the land.
+"""
+
+from typing import List, Optional
+
+from pymongo.database import Database
+
+from indexer.state import MAP_HEIGHT, MAP_WIDTH, buildings_grid
+from indexer.utils import encode_int_as_bytes
+
+
+# The grid of land, built from its buildings for the lands indexed before the
+# grids existed. It's set on land, to be stored with the land.
+async def land_buildings_grid(info, land: dict) -> List[List[int]]:
+    if land.get("buildings_grid") is None:
+        buildings = await info.storage.find("buildings", {"land_id": land["land_id"]})
+        land["buildings_grid"] = buildings_grid(buildings)
+    return land["buildings_grid"]
+
+
+def find_cells(db: Database, land_id: bytes, x0: int, y0: int, x1: int, y1: int) -> Optional[List[dict]]:
+    """Cells of land_id in the rectangle (x0, y0)-(x1, y1), bounds included.
+
+    The rectangle is clipped to the map. Each cell is {x, y, value, building}
+    with value the cell of the map and building the document of the building
+    on it or None. None if the land isn't initialized.
+    """
+    x0, y0 = max(x0, 1), max(y0, 1)
+    x1, y1 = min(x1, MAP_WIDTH), min(y1, MAP_HEIGHT)
+
+    rows = {"$slice": [max(y0 - 1, 0), max(y1 - y0 + 1, 1)]}
+    land = db["lands"].find_one(
+        {"land_id": land_id, "_chain.valid_to": None},
+        {"map": rows, "buildings_grid": rows},
+    )
+    if land is None:
+        return None
+    if x0 > x1 or y0 > y1:
+        return []
+
+    grid = land.get("buildings_grid")
+    if grid is None:
+        buildings = db["buildings"].find({"land_id": land_id, "_chain.valid_to": None})
+        grid = buildings_grid(buildings)[y0 - 1:y1]
+
+    cells = []
+    for y, values, uids in zip(range(y0, y1 + 1), land["map"], grid):
+        for x in range(x0, x1 + 1):
+            cells.append({"x": x, "y": y, "value": values[x - 1], "building": uids[x - 1]})
+
+    uids = {cell["building"] for cell in cells if cell["building"]}
+    buildings = {}
+    if uids:
+        query = db["buildings"].find(
+            {
+                "land_id": land_id,
+                "building_uid": {"$in": [encode_int_as_bytes(uid) for uid in uids]},
+                "_chain.valid_to": None,
+            }
+        )
+        buildings = {int.from_bytes(b["building_uid"], "big"): b for b in query}
+    for cell in cells:
+        cell["building"] = buildings.get(cell["building"])
+    return cells
@@ -0,0 +1,226 @@
+"""History of the land maps, as cell deltas and sparse checkpoints.
+
+Each map change made by a handler is stored in `map_deltas`, with the new
+value of the changed cells (1-based positions like the events):
+
+    {"land_id": <32 bytes>, "log_index": 3, "cells": [[12, 4, 20100011199]]}
+
+Full maps are stored in `map_checkpoints` when a land is initialized or reset
+and every CHECKPOINT_DELTAS deltas. Both are inserted through apibara, so
+their block is `_chain.valid_from` and chain reorganizations remove them.
+They are unique by land, block and log_index, a replayed event doesn't
+store them twice.
+
+The map of a land at a block is its last checkpoint up to that block with the
+deltas stored after it applied in chain order. The deltas after a block are
+the changes the clients polling a map need.
+"""
+
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import ASCENDING, DESCENDING, DeleteMany
+from pymongo.database import Database
+
+from indexer.replay import insert_once
+from indexer.state import set_cell
+
+# number of deltas of a land between two checkpoints
+CHECKPOINT_DELTAS = 64
+
+# above this number of changed cells, land_diff returns the full map
+MAX_DIFF_CELLS = 100
+
+# log_index of the checkpoints of the maps rebuilt by rebuild-projections,
+# after the events of their block
+REBUILD_LOG_INDEX = 2**31 - 1
+
+
+async def record_checkpoint(info, land_id: bytes, map: List[List[int]], log_index: int, reason: str):
+    await insert_once(
+        info,
+        "map_checkpoints",
+        {"land_id": land_id, "log_index": log_index, "reason": reason, "map": map},
+    )
+
+
+# Store the cells of land at positions, land["map"] already has their new
+# values. Returns the fields to set on the land document.
+async def record_cells(info, land: dict, log_index: int, positions: List[Tuple[int, int]]) -> dict:
+    cells = [[x, y, land["map"][y - 1][x - 1]] for x, y in positions]
+    await insert_once(
+        info, "map_deltas", {"land_id": land["land_id"], "log_index": log_index, "cells": cells}
+    )
+
+    # lands indexed before the history was recorded have no checkpoint yet
+    count = land.get("deltas_since_checkpoint")
+    if count is None or count + 1 >= CHECKPOINT_DELTAS:
+        await record_checkpoint(info, land["land_id"], land["map"], log_index, "interval")
+        return {"deltas_since_checkpoint": 0}
+    return {"deltas_since_checkpoint": count + 1}
+
+
+def _position(doc: dict) -> Tuple[int, int]:
+    return doc["_chain"]["valid_from"], doc["log_index"]
+
+
+def find_checkpoint(db: Database, land_id: bytes, block: int) -> Optional[dict]:
+    """Last checkpoint of land_id stored up to block."""
+    return db["map_checkpoints"].find_one(
+        {"land_id": land_id, "_chain.valid_from": {"$lte": block}},
+        sort=[("_chain.valid_from", DESCENDING), ("log_index", DESCENDING)],
+    )
+
+
+def find_deltas(db: Database, land_id: bytes, after: Tuple[int, int], block: int):
+    """Deltas of land_id stored after the position `after` and up to block, in chain order."""
+    after_block, after_index = after
+    return db["map_deltas"].find(
+        {
+            "land_id": land_id,
+            "$or": [
+                {"_chain.valid_from": {"$gt": after_block, "$lte": block}},
+                {"_chain.valid_from": after_block, "log_index": {"$gt": after_index}},
+            ],
+        },
+        {"cells": 1, "log_index": 1, "_chain": 1},
+        sort=[("_chain.valid_from", ASCENDING), ("log_index", ASCENDING), ("_id", ASCENDING)],
+    )
+
+
+def land_at(db: Database, land_id: bytes, block: int) -> Optional[dict]:
+    """The map of land_id after the events of block, None before its first checkpoint."""
+    checkpoint = find_checkpoint(db, land_id, block)
+    if checkpoint is None:
+        return None
+
+    map = checkpoint["map"]
+    deltas = 0
+    for delta in find_deltas(db, land_id, _position(checkpoint), block):
+        for x, y, value in delta["cells"]:
+            set_cell(map, x, y, value)
+        deltas += 1
+
+    return {
+        "land_id": land_id,
+        "block": block,
+        "map": map,
+        "checkpoint_block": checkpoint["_chain"]["valid_from"],
+        "deltas": deltas,
+    }
+
+
+def land_diff(db: Database, land_id: bytes, since_block: int, head_block: int) -> Optional[dict]:
+    """The cells of land_id changed after since_block and up to head_block.
+
+    The full map at head_block is returned instead when the land was
+    initialized or reset in between, its history starts after since_block or
+    more than MAX_DIFF_CELLS cells changed. None if the land has no history
+    at head_block.
+    """
+    diff = {"land_id": land_id, "since_block": since_block, "head_block": head_block, "cells": [], "map": None}
+
+    first = db["map_checkpoints"].find_one(
+        {"land_id": land_id, "_chain.valid_from": {"$lte": head_block}},
+        {"_chain": 1},
+        sort=[("_chain.valid_from", ASCENDING), ("log_index", ASCENDING)],
+    )
+    if first is None:
+        return None
+    if since_block >= head_block:
+        return diff
+
+    full = first["_chain"]["valid_from"] > since_block or db["map_checkpoints"].find_one(
+        {
+            "land_id": land_id,
+            "reason": "reset",
+            "_chain.valid_from": {"$gt": since_block, "$lte": head_block},
+        },
+        {"_id": 1},
+    ) is not None
+
+    if not full:
+        # last value of each cell, in the order of their last change
+        cells = {}
+        deltas = db["map_deltas"].find(
+            {"land_id": land_id, "_chain.valid_from": {"$gt": since_block, "$lte": head_block}},
+            {"cells": 1},
+            sort=[("_chain.valid_from", ASCENDING), ("log_index", ASCENDING), ("_id", ASCENDING)],
+        )
+        for delta in deltas:
+            for x, y, value in delta["cells"]:
+                cells.pop((x, y), None)
+                cells[(x, y)] = value
+            if len(cells) > MAX_DIFF_CELLS:
+                full = True
+                break
+        diff["cells"] = [[x, y, value] for (x, y), value in cells.items()]
+
+    if full:
+        diff["cells"] = []
+        diff["map"] = land_at(db, land_id, head_block)["map"]
+    return diff
+
+
+def write_rebuild_checkpoints(
+    db: Database, maps: Dict[bytes, List[List[int]]], block: int, shard: Optional[int] = None
+):
+    """Store the rebuilt maps as reset checkpoints at block.
+
+    landAt serves them from block, and landDiff returns the full map to the
+    clients polling from before it. A rebuild at the same block replaces
+    them. shard is the shard of the lands in a sharded database.
+    """
+    if not maps:
+        return
+    db["map_checkpoints"].delete_many(
+        {"land_id": {"$in": list(maps)}, "log_index": REBUILD_LOG_INDEX, "_chain.valid_from": block}
+    )
+    db["map_checkpoints"].insert_many(
+        [
+            {
+                "land_id": land_id,
+                "log_index": REBUILD_LOG_INDEX,
+                "reason": "reset",
+                "map": map,
+                "_chain": {"valid_from": block, "valid_to": None},
+                **({} if shard is None else {"_shard": shard}),
+            }
+            for land_id, map in maps.items()
+        ],
+        ordered=False,
+    )
+
+
+def prune_land_versions(db: Database, before_block: int, batch_size: int = 1000) -> int:
+    """Delete the versions of the lands documents replaced before before_block.
+
+    Only the versions from the first checkpoint of their land are deleted,
+    landAt rebuilds their maps. The lands indexed before the history existed
+    keep their older versions, the only copy of their maps before it.
+    before_block must be deeper than any chain reorganization, apibara
+    restores the replaced versions of the invalidated blocks.
+    """
+    first_checkpoints = db["map_checkpoints"].aggregate(
+        [
+            {"$match": {"_chain.valid_from": {"$lt": before_block}}},
+            {"$group": {"_id": "$land_id", "block": {"$min": "$_chain.valid_from"}}},
+        ]
+    )
+    deleted = 0
+    requests = []
+    for checkpoint in first_checkpoints:
+        requests.append(
+            DeleteMany(
+                {
+                    "land_id": checkpoint["_id"],
+                    "_chain.valid_from": {"$gte": checkpoint["block"]},
+                    "_chain.valid_to": {"$ne": None, "$lt": before_block},
+                }
+            )
+        )
+        if len(requests) == batch_size:
+            deleted += db["lands"].bulk_write(requests, ordered=False).deleted_count
+            requests = []
+    if requests:
+        deleted += db["lands"].bulk_write(requests, ordered=False).deleted_count
+    return deleted
@@ -0,0 +1,67 @@
+"""Import time of a module, from the `python -X importtime` report.
+
+The module is imported in fresh interpreters, and the report of the fastest
+run is kept: the first runs also compile the bytecode of the modules.
+"""
+
+import os
+import subprocess
+import sys
+from typing import Dict, List, Optional
+
+# packages that the GraphQL server must not import
+indexer_only_packages = ["apibara", "starknet_py", "starkware", "indexer.events", "indexer.indexer"]
+
+
+def import_times(module: str, path: Optional[str] = None) -> List[dict]:
+    """Self and cumulative microseconds of each module imported by module.
+
+    path is prepended to PYTHONPATH, to measure another checkout.
+    """
+    env = dict(os.environ)
+    if path is not None:
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [path, env.get("PYTHONPATH")]))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        env=env,
+        stderr=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+
+    times = []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        times.append({"name": name.strip(), "self": int(self_us), "cumulative": int(cumulative_us)})
+    return times
+
+
+def total_time(times: List[dict]) -> int:
+    """Microseconds of all the imports."""
+    return sum(t["self"] for t in times)
+
+
+def run_import_report(module: str = "indexer.graphql", runs: int = 5, top: int = 15, path: Optional[str] = None):
+    reports = [import_times(module, path) for _ in range(runs)]
+    times = min(reports, key=total_time)
+    names = {t["name"] for t in times}
+    packages: Dict[str, int] = {}
+    for t in times:
+        package = t["name"].split(".")[0]
+        packages[package] = packages.get(package, 0) + t["self"]
+
+    print(f"import {module}: {total_time(times) / 1000:.0f} ms, {len(times)} modules (fastest of {runs} runs)")
+    print("  slowest packages:")
+    for package, us in sorted(packages.items(), key=lambda item: -item[1])[:top]:
+        print(f"    {package}: {us / 1000:.1f} ms")
+    loaded = [
+        package
+        for package in indexer_only_packages
+        if any(name == package or name.startswith(f"{package}.") for name in names)
+    ]
+    print(f"  indexer only packages: {', '.join(loaded) if loaded else 'none'}")
@@ -1,12 +1,24 @@
 import asyncio
 import sys
+from typing import Optional
 
 from apibara import IndexerRunner, Info, NewBlock, NewEvents
 from apibara.indexer.runner import IndexerRunnerConfiguration
+from apibara.indexer.storage import IndexerStorage
 from apibara.model import EventFilter
+from pymongo import MongoClient
+
+from indexer.blocks import BlockBuffer
+from indexer.config import get_games, indexer_id
+from indexer.db import create_indexes, get_db_name, get_indexed_to, record_reorg, with_read_preference
+from indexer.games import game_database
+from indexer.live import MAX_MB, LiveCache
+from indexer.router import GameRouter
+from indexer.shards import Shard, ShardIndexerStorage, ShardRunner, ShardStorage, check_shards
+from indexer.storage import create_bucket_indexes, invalidate_buckets
 
 from indexer.events.transfers import handle_transfer_events
-from indexer.events.init import handle_init_events, handle_reset_events
+from indexer.events.init import handle_init_events, handle_init_owner_events, handle_reset_events
 from indexer.events.harvest import handle_harvest_events
 from indexer.events.destroy import handle_destroy_events
 from indexer.events.build import handle_build_events
@@ -15,108 +27,190 @@ from indexer.events.move import handle_move_events
 from indexer.events.fuel import handle_fuel_events
 from indexer.events.claim import handle_claim_events
 
-indexer_id = "indexer-all3"
-map_address = "0x052c936c5624517d671a6378ab0ede31e4c6d4584357ebb432bb1313af93599c"
-frenslands_address = "0x0274f30014f7456d36b82728eb655f23dfe9ef0b7e0c6ca827052ab2d01a5d65"
+
+event_handlers = {
+    "Transfer": handle_transfer_events,
+    "NewGame": handle_init_events,
+    "HarvestResource": handle_harvest_events,
+    "Destroy": handle_destroy_events,
+    "Build": handle_build_events,
+    "Repair": handle_repair_events,
+    "Move": handle_move_events,
+    "FuelProduction": handle_fuel_events,
+    "Claim": handle_claim_events,
+    "ResetGame": handle_reset_events,
+}
+
+
+def shard_handler(shard: Optional[Shard], ev):
+    """Handler of ev on shard, None when the event is applied by other shards."""
+    handler = event_handlers.get(ev.name)
+    if shard is None or handler is None or shard.applies(ev):
+        return handler
+    # the owners index is on the shard of the tokens
+    if ev.name == "NewGame" and shard.tokens:
+        return handle_init_owner_events
+    return None
+
 
 async def handle_events(info: Info, block_events: NewEvents):
     """Handle a group of events grouped by block."""
     print(f"Received events for block {block_events.block.number}")
 
+    # blocks with events always have their header stored
+    if info.context["blocks"] is not None:
+        info.context["blocks"].flush()
+    # the changes of the handlers to the in-memory lands can be undone by block
+    router = info.context["games"]
+    for context in router.contexts.values():
+        context["live"].begin_block(block_events.block.number)
+
     block_time = block_events.block.timestamp
     print(f"Handle block events: Block No. {block_events.block.number} - {block_time}")
 
+    shard = info.context["shard"]
+    if shard is not None:
+        info = Info(context=info.context, storage=ShardStorage(info.storage, shard))
+
     for ev in block_events.events:
         print(ev.name, ev.transaction_hash.hex())
-        if ev.name == "Transfer":
-            await handle_transfer_events(info, block_events.block, ev)
-        elif ev.name == "NewGame":
-            await handle_init_events(info, block_events.block, ev)
-        elif ev.name == "HarvestResource":
-            await handle_harvest_events(info, block_events.block, ev)
-        elif ev.name == "Destroy":
-            await handle_destroy_events(info, block_events.block, ev)
-        elif ev.name == "Build":
-            await handle_build_events(info, block_events.block, ev)
-        elif ev.name == "Repair":
-            await handle_repair_events(info, block_events.block, ev)
-        elif ev.name == "Move":
-            await handle_move_events(info, block_events.block, ev)
-        elif ev.name == "FuelProduction":
-            await handle_fuel_events(info, block_events.block, ev)
-        elif ev.name == "Claim":
-            await handle_claim_events(info, block_events.block, ev)
-        elif ev.name == "ResetGame":
-            await handle_reset_events(info, block_events.block, ev)
+        handler = shard_handler(shard, ev)
+        if handler is None:
+            continue
+        # the instances listening to the contract of the event
+        for game_info in router.route(info, ev):
+            await handler(game_info, block_events.block, ev)
 
 
 async def handle_block(info: Info, block: NewBlock):
-    # Store the block information in the database.
+    # Buffer the block information, it's written to the database in bulk.
     print(f"Block: {block.new_head.number}")
-    block = {
-        "number": block.new_head.number,
-        "hash": block.new_head.hash,
-        "timestamp": block.new_head.timestamp.isoformat(),
-    }
-    await info.storage.insert_one("blocks", block)
-
-
-async def run_indexer(server_url=None, mongo_url=None, restart=None):
-    print("Starting Apibara indexer")
-    
-    runner = IndexerRunner(
-        config=IndexerRunnerConfiguration(
-            apibara_url=server_url,
-            apibara_ssl=True,
-            storage_url=mongo_url,
-        ),
-        reset_state=restart,
-        indexer_id=indexer_id,
-        new_events_handler=handle_events,
+    if info.context["blocks"] is not None:
+        info.context["blocks"].add(block.new_head)
+
+    # filters of the games added since the first start, apibara stores them
+    # and scans the block again
+    if info.context["new_filters"]:
+        print(f"Adding {len(info.context['new_filters'])} event filters")
+        info.add_event_filters(info.context["new_filters"])
+        info.context["new_filters"] = []
+
+
+async def handle_reorg(info: Info, block_number: int):
+    print(f"Reorg: invalidated from block {block_number}")
+    if info.context["blocks"] is not None:
+        info.context["blocks"].discard_from(block_number)
+    shard = info.context["shard"]
+    # for the GraphQL servers, see LiveCache.refresh
+    record_reorg(info.context["db"], shard.indexer_id if shard is not None else indexer_id, block_number)
+    for context in info.context["games"].contexts.values():
+        # apibara only invalidates the documents it versioned
+        invalidate_buckets(context["db"], block_number, shard.index if shard is not None else None)
+        # the lands changed by the invalidated blocks get their previous version
+        context["live"].rollback(block_number)
+
+
+def unfinished_block(db, runner_id: str) -> Optional[int]:
+    """The block handled when the indexer stopped, delivered again by apibara."""
+    indexed_to = get_indexed_to(db, runner_id)
+    if indexed_to is None:
+        return None
+    return indexed_to + 1
+
+
+async def run_indexer(
+    server_url=None, mongo_url=None, restart=None, preload_workers=4, preload_max_mb=MAX_MB, shard=None
+):
+    print("Starting Apibara indexer" if shard is None else f"Starting shard {shard.index} of {shard.count}")
+
+    # the handlers read what they just wrote, never from a secondary
+    mongo_url = with_read_preference(mongo_url, "primary")
+    mongo = MongoClient(mongo_url)
+    db = mongo[get_db_name(indexer_id)]
+    if restart:
+        if shard is not None:
+            raise RuntimeError("The database is shared by the shards, drop it before starting them")
+        mongo.drop_database(db.name)
+    check_shards(db, shard)
+
+    runner_id = indexer_id if shard is None else shard.indexer_id
+    blocks = None
+    if shard is None:
+        blocks = BlockBuffer(db)
+    elif shard.tokens:
+        blocks = BlockBuffer(db, shard=shard.index)
+
+    # The runner invalidates the unfinished block itself when it starts, but
+    # only after the lands below are loaded in memory: invalidated first so
+    # that the in-memory lands don't have its writes.
+    block_number = unfinished_block(db, runner_id)
+    if block_number is not None:
+        print(f"Discarding the writes of the unfinished block {block_number}")
+        if shard is None:
+            IndexerStorage(mongo_url, indexer_id).invalidate(block_number)
+        else:
+            ShardIndexerStorage(mongo_url, shard).invalidate(block_number)
+
+    games = get_games()
+    contexts = {}
+    for game in games:
+        game_db = game_database(db, game["namespace"])
+        create_indexes(game_db)
+        create_bucket_indexes(game_db)
+        # the buckets are written outside of apibara
+        if block_number is not None:
+            invalidate_buckets(game_db, block_number, shard.index if shard is not None else None)
+
+        # the handlers read the lands from memory, 0 workers to disable. The
+        # buildings are read from Mongo, see indexer.live. The ceiling is
+        # shared by the games.
+        live = LiveCache(preload_max_mb * 2**20 // len(games), indexer_id=runner_id)
+        if preload_workers > 0:
+            live.preload(game_db, ["lands"], workers=preload_workers)
+
+        contexts[game["name"]] = {
+            "network": "starknet-goerli",
+            "blocks": blocks,
+            "db": game_db,
+            "live": live,
+            "shard": shard,
+        }
+    router = GameRouter(contexts)
+    filters = router.filters()
+
+    config = IndexerRunnerConfiguration(
+        apibara_url=server_url,
+        apibara_ssl=True,
+        storage_url=mongo_url,
     )
+    # database already dropped above, keep the indexes
+    if shard is None:
+        runner = IndexerRunner(
+            config=config, reset_state=False, indexer_id=indexer_id, new_events_handler=handle_events
+        )
+    else:
+        runner = ShardRunner(config=config, reset_state=False, shard=shard, new_events_handler=handle_events)
+
+    # apibara keeps the filters of the first start
+    state = db["_apibara"].find_one({"indexer_id": runner_id}, {"filters": 1})
+    new_filters = []
+    if state is not None:
+        stored = [EventFilter.from_json(f) for f in state.get("filters", [])]
+        new_filters = [f for f in filters if f not in stored]
 
     runner.set_context({
-        "network": "starknet-goerli"
+        "network": "starknet-goerli",
+        "db": db,
+        "blocks": blocks,
+        "games": router,
+        "new_filters": new_filters,
+        "shard": shard,
     })
 
     runner.add_block_handler(handle_block)
+    runner.add_reorg_handler(handle_reorg)
 
-    runner.add_event_filters(
-        filters=[
-            EventFilter.from_event_name(
-                name="Transfer",
-                address="0x052c936c5624517d671a6378ab0ede31e4c6d4584357ebb432bb1313af93599c",
-            ),
-            EventFilter.from_event_name(
-                name="NewGame", address=frenslands_address
-            ),
-            EventFilter.from_event_name(
-                name="HarvestResource", address=frenslands_address
-            ),
-            EventFilter.from_event_name(
-                name="Destroy", address=frenslands_address
-            ),
-            EventFilter.from_event_name(
-                name="Build", address=frenslands_address
-            ),
-            EventFilter.from_event_name(
-                name="Repair", address=frenslands_address
-            ),
-            EventFilter.from_event_name(
-                name="Move", address=frenslands_address
-            ),
-            EventFilter.from_event_name(
-                name="FuelProduction", address=frenslands_address
-            ),
-            EventFilter.from_event_name(
-                name="Claim", address=frenslands_address
-            ),
-            EventFilter.from_event_name(
-                name="ResetGame", address=frenslands_address
-            ),
-        ],
-        index_from_block=300_000,
-    )
-    print("Initialization completed. Entering main loop.")
+    runner.add_event_filters(filters=filters, index_from_block=300_000)
+    print(f"Indexing {len(games)} games with {len(filters)} event filters. Entering main loop.")
 
-    await runner.run()
\ No newline at end of file
+    await runner.run()
@@ -0,0 +1,170 @@
+"""Limits protecting the GraphQL server: page sizes and query cost."""
+
+from typing import Dict, Optional
+
+from graphql import (
+    FieldNode,
+    FragmentSpreadNode,
+    GraphQLError,
+    GraphQLList,
+    GraphQLObjectType,
+    OperationDefinitionNode,
+    VariableNode,
+    get_named_type,
+    get_nullable_type,
+    value_from_ast_untyped,
+)
+from graphql.execution import ExecutionResult
+from strawberry.extensions import Extension
+
+from indexer.metrics import metrics
+
+# maximum number of items returned by a list resolver
+MAX_PAGE_SIZE = 100
+
+# default maximum cost of a query, see QueryCostExtension
+MAX_QUERY_COST = 10_000
+
+# estimated number of items of the lists without a limit argument
+DEFAULT_LIST_SIZE = 10
+list_sizes = {
+    "LandBuildings.buildings": 25,
+    "LandDiff.cells": 10,
+    "Query.neighbours": 8,
+}
+
+# cost of the fields that aren't objects, other scalar fields are free
+field_costs = {
+    "Query.wasInit": 1,
+    "Query.blockAt": 1,
+    "Land.map": 4,
+    "Land.mapGrid": 1,
+    "Land.packedMap": 1,
+    "LandSnapshot.map": 4,
+    "LandSnapshot.mapGrid": 1,
+    "LandSnapshot.packedMap": 1,
+    "LandDiff.map": 4,
+    "LandDiff.mapGrid": 1,
+    "LandDiff.packedMap": 1,
+    "LandCells.freeMask": 1,
+}
+
+# buckets of the graphql_query_cost histogram
+cost_buckets = [1, 10, 100, 1_000, 10_000, 100_000]
+
+
+def page_size(limit: int) -> int:
+    """limit capped to MAX_PAGE_SIZE, a limit of 0 would return everything."""
+    if limit <= 0 or limit > MAX_PAGE_SIZE:
+        return MAX_PAGE_SIZE
+    return limit
+
+
+def _argument(field: FieldNode, name: str, variables: Dict):
+    for argument in field.arguments:
+        if argument.name.value != name:
+            continue
+        if isinstance(argument.value, VariableNode):
+            return variables.get(argument.value.name.value)
+        return value_from_ast_untyped(argument.value, variables)
+    return None
+
+
+def _list_size(key: str, field: FieldNode, field_def, variables: Dict) -> int:
+    limit = _argument(field, "limit", variables)
+    if limit is None and "limit" in field_def.args:
+        limit = field_def.args["limit"].default_value
+    if isinstance(limit, int):
+        return page_size(limit)
+
+    land_ids = _argument(field, "landIds", variables)
+    if isinstance(land_ids, list):
+        return len(land_ids)
+
+    return list_sizes.get(key, DEFAULT_LIST_SIZE)
+
+
+def selection_cost(parent_type: GraphQLObjectType, selection_set, fragments, variables) -> int:
+    cost = 0
+    for selection in selection_set.selections:
+        if isinstance(selection, FragmentSpreadNode):
+            fragment = fragments.get(selection.name.value)
+            if fragment is not None:
+                cost += selection_cost(parent_type, fragment.selection_set, fragments, variables)
+            continue
+        if not isinstance(selection, FieldNode):
+            # inline fragments, the schema has no interfaces or unions
+            cost += selection_cost(parent_type, selection.selection_set, fragments, variables)
+            continue
+
+        field_def = parent_type.fields.get(selection.name.value)
+        if field_def is None:
+            # __typename and introspection
+            continue
+        key = f"{parent_type.name}.{selection.name.value}"
+        field_type = get_named_type(field_def.type)
+        if not isinstance(field_type, GraphQLObjectType):
+            cost += field_costs.get(key, 0)
+            continue
+
+        item_cost = 1 + selection_cost(field_type, selection.selection_set, fragments, variables)
+        if isinstance(get_nullable_type(field_def.type), GraphQLList):
+            item_cost *= _list_size(key, selection, field_def, variables)
+        cost += item_cost
+    return cost
+
+
+def query_cost(schema, document, operation_name: Optional[str], variables: Optional[Dict]) -> int:
+    """Estimated number of objects fetched and built to answer the query.
+
+    Each object costs 1 plus the cost of its fields, lists multiply the cost
+    of their items by their `limit`, the number of `landIds` or an estimate.
+    """
+    fragments = {}
+    operation = None
+    for definition in document.definitions:
+        if isinstance(definition, OperationDefinitionNode):
+            if operation is None or (definition.name and definition.name.value == operation_name):
+                operation = definition
+        else:
+            fragments[definition.name.value] = definition
+    if operation is None:
+        return 0
+    root = schema.get_root_type(operation.operation)
+    return selection_cost(root, operation.selection_set, fragments, variables or {})
+
+
+class QueryCostExtension(Extension):
+    """Reject the queries costing more than max_cost, 0 to accept all."""
+
+    def __init__(self, *, execution_context=None, max_cost: int = MAX_QUERY_COST):
+        self.execution_context = execution_context
+        self.max_cost = max_cost
+        self.cost = None
+
+    def on_executing_start(self):
+        context = self.execution_context
+        self.cost = query_cost(
+            context.schema._schema,
+            context.graphql_document,
+            context.operation_name,
+            context.variables,
+        )
+        metrics.observe("graphql_query_cost", self.cost, cost_buckets)
+        if self.max_cost and self.cost > self.max_cost:
+            metrics.inc("graphql_queries_rejected_total", reason="cost")
+            # a result set before execution skips it
+            context.result = ExecutionResult(
+                data=None,
+                errors=[
+                    GraphQLError(
+                        f"Query cost {self.cost} exceeds the maximum of {self.max_cost}",
+                        extensions={"code": "QUERY_TOO_EXPENSIVE"},
+                    )
+                ],
+            )
+
+    def get_results(self):
+        if self.cost is None:
+            return {}
+        return {"cost": {"requested": self.cost, "maximum": self.max_cost}}
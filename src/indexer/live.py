@@ -0,0 +1,405 @@
+"""In-memory copies of the current lands, buildings and tokens documents.
+
+The copies are loaded at startup by `preload`: each collection is split in
+ranges of `_id` read by parallel cursors in large batches. The maps and
+buildings grids of the lands are kept as flat arrays of int64 instead of
+lists of Python ints, about 5 KB per map instead of 25 KB. The reads return
+new lists, the handlers can change them in place.
+
+The cache is bounded by max_bytes, an estimate of the size of the copies.
+The lands and tokens missing when the ceiling is reached are read from Mongo
+as before, the buildings are only served when all of them fit.
+
+The GraphQL server keeps its copy up to date with `refresh`, which reads the
+documents replaced and added since the last indexed block it has seen. The
+chain reorganizations are recorded by the indexer in `_reorgs`, see
+`db.record_reorg`. The
+indexer updates its copy of the lands in the handlers, with `find_land` and
+`update_land`. It doesn't keep the buildings: the handlers read one building
+or the buildings of one land by an index, and they are written by most
+handlers, each write would have to update the copy as well.
+
+Each change is recorded with the document it replaced in an undo log of the
+last UNDO_BLOCKS blocks, started by `begin_block`. On a chain reorganization
+`rollback` restores the replaced documents of the invalidated blocks instead
+of loading the copies again, only a reorganization deeper than the log
+clears them.
+"""
+
+import sys
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from pymongo.database import Database
+
+from indexer.db import get_indexed_to, get_reorgs
+from indexer.replay import not_applied
+from indexer.state import MAP_WIDTH
+
+live_collections = ["lands", "buildings", "tokens"]
+
+# fields of the lands with a value per cell
+grid_fields = ["map", "buildings_grid"]
+
+# default memory ceiling, in MB
+MAX_MB = 512
+
+# number of blocks whose changes can be undone after a chain reorganization
+UNDO_BLOCKS = 100
+
+
+def id_ranges(db: Database, collection: str, parts: int) -> list:
+    """Split the _id index of collection in about parts ranges, as (min, max) bounds."""
+    count = db[collection].estimated_document_count()
+    if parts <= 1 or count < parts:
+        return [(None, None)]
+
+    bounds = []
+    step = count // parts
+    for i in range(1, parts):
+        for doc in db[collection].find({}, {"_id": 1}).sort("_id", 1).skip(i * step).limit(1):
+            bounds.append(doc["_id"])
+    bounds = [None] + sorted(set(bounds)) + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _range_filter(low, high) -> dict:
+    filter = {"_chain.valid_to": None}
+    if low is not None or high is not None:
+        filter["_id"] = {}
+    if low is not None:
+        filter["_id"]["$gte"] = low
+    if high is not None:
+        filter["_id"]["$lt"] = high
+    return filter
+
+
+def _public(doc: dict) -> dict:
+    return {k: v for k, v in doc.items() if k != "_size"}
+
+
+def _rows(cells: array) -> List[List[int]]:
+    return [cells[i:i + MAP_WIDTH].tolist() for i in range(0, len(cells), MAP_WIDTH)]
+
+
+def _key(collection: str, doc: dict) -> tuple:
+    if collection == "lands":
+        return (doc["land_id"],)
+    if collection == "buildings":
+        return (doc["land_id"], doc["building_uid"])
+    return (doc["token_id"],)
+
+
+def _size(doc: dict) -> int:
+    return sys.getsizeof(doc) + sum(sys.getsizeof(value) for value in doc.values())
+
+
+class LiveCache:
+    def __init__(self, max_bytes: int = MAX_MB * 2**20, undo_blocks: int = UNDO_BLOCKS, indexer_id: Optional[str] = None):
+        self.max_bytes = max_bytes
+        self.undo_blocks = undo_blocks
+        # indexer whose blocks the copies follow, all of them (the shards) by default
+        self.indexer_id = indexer_id
+        self.size = 0
+        # collections with all their current documents in memory
+        self.complete = dict.fromkeys(live_collections, False)
+        self._lock = threading.RLock()
+        self._lands: Dict[bytes, dict] = {}
+        self._buildings: Dict[bytes, Dict[bytes, dict]] = {}
+        self._tokens: Dict[bytes, dict] = {}
+        self._collections = []
+        self._workers = 1
+        self._loading = set()
+        self._indexed_to = None
+        # number of reorganizations of each indexer seen by refresh
+        self._reorgs: Optional[Dict[str, int]] = None
+        # (block, [(collection, key, previous document or None)]) of the
+        # last blocks, the changes of the blocks up to _undo_floor can't be
+        # undone
+        self._undo: Deque[Tuple[int, list]] = deque()
+        self._undo_floor = -1
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._lands) + sum(len(b) for b in self._buildings.values()) + len(self._tokens)
+
+    # reads, the returned documents can be modified
+
+    def land(self, land_id: bytes) -> Optional[dict]:
+        with self._lock:
+            land = self._lands.get(land_id)
+            if land is None:
+                return None
+            return _public(dict(land, **{name: _rows(land[name]) for name in grid_fields if land.get(name) is not None}))
+
+    def buildings(self, land_id: bytes) -> Optional[List[dict]]:
+        """The buildings of land_id, None when the buildings aren't all in memory."""
+        with self._lock:
+            if not self.complete["buildings"]:
+                return None
+            return [_public(b) for b in self._buildings.get(land_id, {}).values()]
+
+    def token(self, token_id: bytes) -> Optional[dict]:
+        with self._lock:
+            token = self._tokens.get(token_id)
+            return _public(token) if token is not None else None
+
+    # writes
+
+    def put(self, collection: str, doc: dict) -> bool:
+        """Store the current version of doc, False when over the memory ceiling."""
+        if collection == "buildings" and not self.complete[collection] and collection not in self._loading:
+            return False
+        doc = {k: v for k, v in doc.items() if k not in ("_id", "_chain", "_size")}
+        size = _size(doc)
+        if collection == "lands":
+            for name in grid_fields:
+                if doc.get(name) is not None:
+                    doc[name] = array("q", [cell for row in doc[name] for cell in row])
+                    size += doc[name].buffer_info()[1] * doc[name].itemsize
+        doc["_size"] = size
+
+        with self._lock:
+            key = _key(collection, doc)
+            previous = self._get(collection, key)
+            if self.size - (previous["_size"] if previous is not None else 0) + size > self.max_bytes:
+                self._set(collection, key, None)
+                if collection == "buildings" and self.complete["buildings"]:
+                    # a partial copy of the buildings can't be used
+                    self._clear("buildings")
+                return False
+            self._set(collection, key, doc)
+            return True
+
+    def remove(self, collection: str, key: dict):
+        """Remove the document with the key fields of key."""
+        with self._lock:
+            self._set(collection, _key(collection, key), None)
+
+    def _get(self, collection: str, key: tuple) -> Optional[dict]:
+        if collection == "lands":
+            return self._lands.get(key[0])
+        if collection == "buildings":
+            return self._buildings.get(key[0], {}).get(key[1])
+        return self._tokens.get(key[0])
+
+    def _set(self, collection: str, key: tuple, doc: Optional[dict], record: bool = True):
+        """Replace the document of key by doc, remove it when doc is None."""
+        previous = self._get(collection, key)
+        if previous is None and doc is None:
+            return
+        if collection == "lands":
+            docs, name = self._lands, key[0]
+        elif collection == "buildings":
+            docs, name = self._buildings.setdefault(key[0], {}), key[1]
+        else:
+            docs, name = self._tokens, key[0]
+
+        if doc is None:
+            del docs[name]
+            if collection == "buildings" and not docs:
+                del self._buildings[key[0]]
+        else:
+            docs[name] = doc
+        self.size += (doc["_size"] if doc is not None else 0) - (previous["_size"] if previous is not None else 0)
+        if record and self._undo:
+            self._undo[-1][1].append((collection, key, previous))
+
+    def _clear(self, collection: str):
+        with self._lock:
+            if collection == "lands":
+                docs = list(self._lands.values())
+                self._lands = {}
+            elif collection == "buildings":
+                docs = [b for land in self._buildings.values() for b in land.values()]
+                self._buildings = {}
+            else:
+                docs = list(self._tokens.values())
+                self._tokens = {}
+            self.size -= sum(doc["_size"] for doc in docs)
+            self.complete[collection] = False
+            for _, changes in self._undo:
+                changes[:] = [change for change in changes if change[0] != collection]
+
+    def clear(self):
+        with self._lock:
+            for collection in live_collections:
+                self._clear(collection)
+            self._undo.clear()
+            self._undo_floor = -1
+
+    # chain reorganizations
+
+    def begin_block(self, block: int):
+        """Record the next changes as changes of block, until the next call."""
+        with self._lock:
+            if self._undo and self._undo[-1][0] == block:
+                return
+            self._undo.append((block, []))
+            while self._undo[0][0] <= block - self.undo_blocks:
+                self._undo_floor = self._undo.popleft()[0]
+
+    def rollback(self, block: int) -> bool:
+        """Undo the changes of the blocks from block, in reverse order.
+
+        When the log doesn't go back to block the copies are cleared instead
+        and False is returned.
+        """
+        with self._lock:
+            if block <= self._undo_floor:
+                print(f"Reorg at block {block} deeper than the undo log, clearing the in-memory copies")
+                self.clear()
+                return False
+            while self._undo and self._undo[-1][0] >= block:
+                _, changes = self._undo.pop()
+                for collection, key, previous in reversed(changes):
+                    self._set(collection, key, previous, record=False)
+            return True
+
+    # loading
+
+    def preload(self, db: Database, collections=live_collections, workers: int = 4, batch_size: int = 10_000):
+        """Load the current documents of collections, with workers parallel cursors."""
+        # documents changed while loading are read again by the next refresh
+        self._reorgs = self._get_reorgs(db)
+        self._indexed_to = self._get_indexed_to(db)
+        with self._lock:
+            self._undo.clear()
+            self._undo_floor = self._indexed_to if self._indexed_to is not None else -1
+        self._collections = list(collections)
+        self._workers = workers
+        for collection in collections:
+            self._loading.add(collection)
+            try:
+                self._preload(db, collection, workers, batch_size)
+            finally:
+                self._loading.discard(collection)
+
+    def _preload(self, db: Database, collection: str, workers: int, batch_size: int):
+        start = time.time()
+        self._clear(collection)
+        # more ranges than workers, the ranges aren't equally filled
+        ranges = id_ranges(db, collection, workers * 4)
+        full = threading.Event()
+
+        def load(bounds) -> int:
+            loaded = 0
+            for doc in db[collection].find(_range_filter(*bounds), batch_size=batch_size):
+                if full.is_set():
+                    break
+                if not self.put(collection, doc):
+                    full.set()
+                    break
+                loaded += 1
+            return loaded
+
+        total = 0
+        with ThreadPoolExecutor(max(workers, 1)) as pool:
+            for done, loaded in enumerate(pool.map(load, ranges), 1):
+                total += loaded
+                print(
+                    f"Preloading {collection}: {done}/{len(ranges)} ranges, "
+                    f"{total} documents, {self.size / 2**20:.0f} MB"
+                )
+
+        if full.is_set():
+            print(f"Preloading {collection} stopped at the ceiling of {self.max_bytes / 2**20:.0f} MB")
+            if collection == "buildings":
+                self._clear(collection)
+        else:
+            self.complete[collection] = True
+        print(f"Preloaded {total} {collection} in {time.time() - start:.1f}s")
+
+    # GraphQL server
+
+    def _get_indexed_to(self, db: Database) -> Optional[int]:
+        return get_indexed_to(db, self.indexer_id)
+
+    def _get_reorgs(self, db: Database) -> Dict[str, int]:
+        return {id: doc["count"] for id, doc in get_reorgs(db, self.indexer_id).items()}
+
+    def _invalidated_from(self, db: Database) -> Optional[int]:
+        """First block invalidated by the reorganizations since the last call, -1 when unknown."""
+        reorgs = get_reorgs(db, self.indexer_id)
+        seen, self._reorgs = self._reorgs, {id: doc["count"] for id, doc in reorgs.items()}
+        if seen is None:
+            return None
+        blocks = []
+        for id, doc in reorgs.items():
+            new = doc["count"] - seen.get(id, 0)
+            if new > len(doc["blocks"]):
+                return -1
+            if new > 0:
+                blocks.extend(doc["blocks"][-new:])
+        return min(blocks) if blocks else None
+
+    def refresh(self, db: Database):
+        """Apply the documents replaced and added in the blocks indexed since the last call."""
+        # the reorganizations are read before the indexed block, one recorded
+        # in between is undone by the next call
+        invalidated_from = self._invalidated_from(db)
+        indexed_to = self._get_indexed_to(db)
+        synced_to = self._indexed_to if self._indexed_to is not None else -1
+        if indexed_to is None:
+            return
+        if indexed_to < synced_to and (invalidated_from is None or invalidated_from > indexed_to + 1):
+            # reorganization of an indexer not recording them
+            invalidated_from = indexed_to + 1
+        if invalidated_from is not None and invalidated_from <= synced_to:
+            # chain reorganization, possibly already indexed again to the
+            # same block: the blocks synced from invalidated_from are undone
+            # and synced again from the last block kept
+            if not self.rollback(invalidated_from):
+                self.preload(db, self._collections, self._workers)
+                return
+            synced_to = self._undo[-1][0] if self._undo else self._undo_floor
+        if indexed_to == synced_to:
+            self._indexed_to = indexed_to
+            return
+
+        # the changes of the blocks synced are recorded at the last one
+        self.begin_block(indexed_to)
+        blocks = {"$gt": synced_to, "$lte": indexed_to}
+        for collection in self._collections:
+            for doc in db[collection].find({"_chain.valid_to": blocks}):
+                self.remove(collection, doc)
+            for doc in db[collection].find({"_chain.valid_to": None, "_chain.valid_from": blocks}):
+                self.put(collection, doc)
+        self._indexed_to = indexed_to
+
+
+# Indexer: the handlers read and update the lands through the cache of the
+# indexer, when it has one.
+
+async def find_land(info, land_id: bytes) -> Optional[dict]:
+    live = info.context.get("live")
+    land = live.land(land_id) if live is not None else None
+    if land is None:
+        land = await info.storage.find_one("lands", {"land_id": land_id})
+        if land is not None and live is not None:
+            live.put("lands", land)
+    return land
+
+
+# The handlers check with `replay.applied` that the land doesn't have the
+# changes of the event at position yet.
+async def update_land(info, land: dict, fields: dict, position: int):
+    fields = dict(fields, applied_at=position)
+    await info.storage.find_one_and_update(
+        "lands", not_applied({"land_id": land["land_id"]}, position), {"$set": fields}
+    )
+    live = info.context.get("live")
+    if live is not None:
+        live.put("lands", dict(land, **fields))
+
+
+async def insert_land(info, land: dict, position: int):
+    land = dict(land, applied_at=position)
+    await info.storage.insert_one("lands", land)
+    live = info.context.get("live")
+    if live is not None:
+        live.put("lands", land)
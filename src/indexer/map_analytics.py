@@ -0,0 +1,82 @@
+"""Analytics of many land maps at once, with NumPy.
+
+The maps are loaded in one (lands, MAP_HEIGHT, MAP_WIDTH) tensor of cells.
+A non empty cell is a `block_comp` of 11 digits, e.g. 10100011199:
+
+    1      01       0001   1199
+    kind   type id  uid    state
+
+Positions are 1-based (x, y) like in the events.
+"""
+
+from typing import Dict, List, Tuple
+
+import numpy as np
+from pymongo.database import Database
+
+from indexer.state import MAP_HEIGHT, MAP_WIDTH
+
+
+def load_maps(db: Database, land_ids: List[bytes]) -> Tuple[List[bytes], np.ndarray]:
+    """The ids of the initialized lands among land_ids and their maps."""
+    query = db["lands"].find(
+        {"land_id": {"$in": land_ids}, "_chain.valid_to": None},
+        {"_id": 0, "land_id": 1, "map": 1},
+    )
+    maps = {land["land_id"]: land["map"] for land in query}
+    found = [land_id for land_id in land_ids if land_id in maps]
+    cells = np.array([maps[land_id] for land_id in found], dtype=np.int64)
+    return found, cells.reshape(len(found), MAP_HEIGHT, MAP_WIDTH)
+
+
+def cell_counts(cells: np.ndarray) -> List[Dict[Tuple[int, int], int]]:
+    """Number of cells of each (kind, type id) of each land, without the empty cells."""
+    # kind * 100 + type id, one code per (land, kind, type id) below
+    codes = (cells // 10**8).reshape(len(cells), -1)
+    # cells with more digits aren't block_comp
+    codes = np.where(codes < 1000, codes, 0)
+    codes = codes + np.arange(len(cells))[:, None] * 1000
+    counts = np.bincount(codes.ravel(), minlength=len(cells) * 1000).reshape(len(cells), 1000)
+
+    counts[:, 0] = 0
+    lands = [{} for _ in range(len(cells))]
+    for land, code in zip(*np.nonzero(counts)):
+        lands[land][(int(code) // 100, int(code) % 100)] = int(counts[land, code])
+    return lands
+
+
+def free_mask(cells: np.ndarray) -> np.ndarray:
+    return cells == 0
+
+
+def placements(cells: np.ndarray, width: int, height: int) -> np.ndarray:
+    """Mask of the positions where a width x height rectangle only covers free cells.
+
+    The mask of a land is indexed by [y - 1, x - 1] of the top left cell of
+    the rectangle.
+    """
+    if width < 1 or height < 1:
+        raise ValueError("width and height must be at least 1")
+    lands = len(cells)
+    if width > MAP_WIDTH or height > MAP_HEIGHT:
+        return np.zeros((lands, MAP_HEIGHT, MAP_WIDTH), dtype=bool)
+
+    # number of occupied cells of each rectangle, with summed area tables
+    occupied = np.zeros((lands, MAP_HEIGHT + 1, MAP_WIDTH + 1), dtype=np.int32)
+    occupied[:, 1:, 1:] = (cells != 0).cumsum(axis=1).cumsum(axis=2)
+    sums = (
+        occupied[:, height:, width:]
+        - occupied[:, :-height, width:]
+        - occupied[:, height:, :-width]
+        + occupied[:, :-height, :-width]
+    )
+
+    mask = np.zeros((lands, MAP_HEIGHT, MAP_WIDTH), dtype=bool)
+    mask[:, : MAP_HEIGHT - height + 1, : MAP_WIDTH - width + 1] = sums == 0
+    return mask
+
+
+def positions(mask: np.ndarray, limit: int) -> List[Tuple[int, int]]:
+    """The first limit (x, y) positions of a land mask, row by row."""
+    ys, xs = np.nonzero(mask)
+    return [(int(x) + 1, int(y) + 1) for y, x in zip(ys[:limit], xs[:limit])]
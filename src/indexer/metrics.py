@@ -0,0 +1,37 @@
+from collections import defaultdict
+from typing import Dict, Tuple
+
+
+class Metrics:
+    """Process-wide counters, exported in the Prometheus text format."""
+
+    def __init__(self):
+        self._counters: Dict[Tuple[str, Tuple], float] = defaultdict(float)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        self._counters[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, name: str, value: float, buckets, **labels):
+        """Add value to the histogram name, with cumulative buckets."""
+        for bucket in buckets:
+            if value <= bucket:
+                self.inc(f"{name}_bucket", le=str(bucket), **labels)
+        self.inc(f"{name}_bucket", le="+Inf", **labels)
+        self.inc(f"{name}_sum", value, **labels)
+        self.inc(f"{name}_count", **labels)
+
+    def get(self, name: str, **labels) -> float:
+        return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def render(self) -> str:
+        lines = []
+        for (name, labels), value in sorted(self._counters.items()):
+            if labels:
+                labels = ",".join(f'{k}="{v}"' for k, v in labels)
+                lines.append(f"{name}{{{labels}}} {value:g}")
+            else:
+                lines.append(f"{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
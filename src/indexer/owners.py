@@ -0,0 +1,88 @@
+from pymongo.database import Database
+
+from indexer.replay import applied, not_applied
+
+zero_address = (0).to_bytes(32, "big")
+
+
+# Owner index: one document per owner with the ids of its tokens and lands
+async def add_to_owner(info, owner: bytes, block_time, position: int, token_ids=(), land_ids=()):
+    if owner == zero_address:
+        return
+    existing = await info.storage.find_one("owners", {"owner": owner})
+    if applied(existing, position):
+        return
+    if existing is None:
+        await info.storage.insert_one(
+            "owners",
+            {
+                "owner": owner,
+                "token_ids": list(token_ids),
+                "land_ids": list(land_ids),
+                "updated_at": block_time,
+                "applied_at": position,
+            },
+        )
+        return
+
+    await info.storage.find_one_and_update(
+        "owners",
+        not_applied({"owner": owner}, position),
+        {
+            "$addToSet": {
+                "token_ids": {"$each": list(token_ids)},
+                "land_ids": {"$each": list(land_ids)},
+            },
+            "$set": {"updated_at": block_time, "applied_at": position},
+        },
+    )
+
+
+async def remove_from_owner(info, owner: bytes, block_time, position: int, token_id: bytes):
+    """Remove token_id from the owner tokens and lands."""
+    if owner == zero_address:
+        return
+    existing = await info.storage.find_one("owners", {"owner": owner})
+    if existing is None or applied(existing, position):
+        return
+
+    await info.storage.find_one_and_update(
+        "owners",
+        not_applied({"owner": owner}, position),
+        {
+            "$pull": {"token_ids": token_id, "land_ids": token_id},
+            "$set": {"updated_at": block_time, "applied_at": position},
+        },
+    )
+
+
+async def owns_land(info, owner: bytes, token_id: bytes) -> bool:
+    """Whether token_id is one of the owner's lands."""
+    if owner == zero_address:
+        return False
+    existing = await info.storage.find_one("owners", {"owner": owner})
+    return existing is not None and token_id in existing["land_ids"]
+
+
+# returns the owner document with the live buildings of its lands, in one query
+def get_owner_with_buildings(db: Database, owner: bytes):
+    pipeline = [
+        {"$match": {"owner": owner, "_chain.valid_to": None}},
+        {"$limit": 1},
+        {
+            "$lookup": {
+                # the buildings of the same game as db
+                "from": db["buildings"].name,
+                "localField": "land_ids",
+                "foreignField": "land_id",
+                "pipeline": [
+                    {"$match": {"_chain.valid_to": None, "status": {"$ne": "destroyed"}}},
+                    {"$project": {"_id": 0, "land_id": 1}},
+                ],
+                "as": "buildings",
+            }
+        },
+    ]
+    for doc in db["owners"].aggregate(pipeline):
+        return doc
+    return None
@@ -0,0 +1,344 @@
+"""Rebuild of the `lands` and `buildings` projections from the stored events.
+
+The events of a group of lands are read in bulk, replayed in chain order in
+memory with the state logic of the handlers, and the resulting documents
+replace the current ones. Nothing is streamed again from Apibara.
+
+The indexer must be stopped during the rebuild.
+"""
+
+import multiprocessing
+from typing import Dict, List, Optional
+
+from pymongo import MongoClient
+from pymongo.database import Database
+
+from indexer.state import (
+    buildings_grid,
+    claim_cycles,
+    fuel_cycles,
+    move_cell,
+    new_building,
+    new_cabin,
+    new_land,
+    set_cell,
+)
+from indexer.db import get_indexed_to
+from indexer.games import game_database
+from indexer.history import write_rebuild_checkpoints
+from indexer.storage import find_events, is_bucketed
+
+# event collections changing the lands and buildings
+replayed_collections = [
+    "inits",
+    "resets",
+    "build",
+    "harvest",
+    "fuel",
+    "claims",
+    "repairs",
+    "moves",
+    "destroy",
+]
+
+# fields compared to report the documents changed by the rebuild
+building_fields = [
+    "building_uid", "building_type_id", "pos_x", "pos_y", "status",
+    "decay", "active_cycles", "incoming_cycles", "last_fuel",
+]
+
+
+def _int(value: bytes) -> int:
+    return int.from_bytes(value, "big")
+
+
+def event_order(doc: dict, mixed: bool = False):
+    """Position of an event in the chain.
+
+    The events have their index in the block in log_index, the documents of
+    the plain collections stored before it existed are ordered by _id:
+    pymongo generates them increasing in the indexer process. Their order
+    relative to the bucketed events is unknown, mixed is whether some of
+    the replayed collections are bucketed.
+    """
+    if "log_index" not in doc and mixed:
+        raise ValueError(
+            "Events stored without their log_index can't be ordered with the bucketed events, "
+            "index again with `indexer start --restart`"
+        )
+    return (doc["_chain"]["valid_from"], doc.get("log_index", -1), doc.get("_id", 0))
+
+
+class LandProjection:
+    """The lands and buildings documents of a land, updated event by event."""
+
+    def __init__(self):
+        self.land: Optional[dict] = None
+        # in insertion order, the handlers update the first building of a uid
+        self.buildings: List[dict] = []
+
+    def apply(self, collection: str, event: dict):
+        getattr(self, f"_apply_{collection}")(event)
+
+    def _building(self, uid: bytes) -> Optional[dict]:
+        for building in self.buildings:
+            if building["building_uid"] == uid:
+                return building
+        return None
+
+    def _apply_inits(self, event):
+        self.buildings.append(
+            new_cabin(
+                event["owner"],
+                event["land_id"],
+                event["time"],
+                _int(event["time"]),
+                event["transaction_hash"],
+                event["timestamp"],
+            )
+        )
+        self.land = new_land(event["land_id"], event["time"], event["transaction_hash"], event["timestamp"])
+
+    def _apply_resets(self, event):
+        # the time of the reset documents is their block number
+        self.buildings = [
+            new_cabin(
+                event["owner"],
+                event["land_id"],
+                event["time"],
+                _int(event["time"]),
+                event["transaction_hash"],
+                event["timestamp"],
+            )
+        ]
+        self.land = new_land(event["land_id"], event["time"], event["transaction_hash"], event["timestamp"])
+
+    def _set_cell(self, event, value):
+        if self.land is not None:
+            set_cell(self.land["map"], _int(event["pos_x"]), _int(event["pos_y"]), value)
+            self.land["updated_at"] = event["timestamp"]
+
+    def _apply_build(self, event):
+        self.buildings.append(new_building(event))
+        self._set_cell(event, _int(event["block_comp"]))
+
+    def _apply_harvest(self, event):
+        self._set_cell(event, _int(event["block_comp"]))
+
+    def _apply_fuel(self, event):
+        building = self._building(event["building_uid"])
+        if building is not None:
+            building.update(fuel_cycles(building, _int(event["time"]), _int(event["nb_blocks"])))
+
+    def _apply_claims(self, event):
+        for building in self.buildings:
+            building.update(claim_cycles(building, _int(event["block_number"])))
+
+    def _apply_repairs(self, event):
+        building = self._building(event["building_uid"])
+        if building is not None:
+            building["decay"] = 0
+            building["updated_at"] = event["timestamp"]
+
+    def _apply_moves(self, event):
+        building = self._building(event["infra_uid"])
+        if building is not None:
+            building["pos_x"] = event["new_pos_x"]
+            building["pos_y"] = event["new_pos_y"]
+            building["updated_at"] = event["timestamp"]
+        if self.land is not None:
+            move_cell(
+                self.land["map"],
+                _int(event["pos_x"]),
+                _int(event["pos_y"]),
+                _int(event["new_pos_x"]),
+                _int(event["new_pos_y"]),
+            )
+            self.land["updated_at"] = event["timestamp"]
+
+    def _apply_destroy(self, event):
+        building = self._building(event["building_uid"])
+        if building is not None:
+            self.buildings.remove(building)
+        self._set_cell(event, 0)
+
+
+def replay(db: Database, land_ids: List[bytes], to_block: int, batch_size: int = 10_000) -> Dict[bytes, LandProjection]:
+    """Replay the events of land_ids indexed up to to_block."""
+    events = []
+    mixed = any(map(is_bucketed, replayed_collections))
+    for collection in replayed_collections:
+        query = find_events(
+            db,
+            collection,
+            {
+                "land_id": {"$in": land_ids},
+                "_chain.valid_to": None,
+                "_chain.valid_from": {"$lte": to_block},
+            },
+            [("_chain.valid_from", 1), ("_id", 1)],
+            batch_size=batch_size,
+        )
+        events.extend((event_order(doc, mixed), collection, doc) for doc in query)
+    events.sort(key=lambda event: event[0])
+
+    projections = {land_id: LandProjection() for land_id in land_ids}
+    for _, collection, doc in events:
+        projections[doc["land_id"]].apply(collection, doc)
+    return projections
+
+
+def count_changes(db: Database, projections: Dict[bytes, LandProjection]) -> int:
+    """Number of lands whose map or buildings differ from the stored ones."""
+    current = {land_id: LandProjection() for land_id in projections}
+    filter = {"land_id": {"$in": list(projections)}, "_chain.valid_to": None}
+    for land in db["lands"].find(filter, {"land_id": 1, "map": 1}):
+        current[land["land_id"]].land = land
+    for building in db["buildings"].find(filter, ["land_id"] + building_fields):
+        current[building["land_id"]].buildings.append(building)
+
+    def key(projection: LandProjection):
+        land_map = projection.land["map"] if projection.land is not None else None
+        buildings = sorted(
+            tuple(building.get(name) for name in building_fields)
+            for building in projection.buildings
+        )
+        return land_map, buildings
+
+    return sum(1 for land_id, projection in projections.items() if key(projection) != key(current[land_id]))
+
+
+def write_projections(
+    db: Database, projections: Dict[bytes, LandProjection], block: int, shard: Optional[int] = None
+):
+    """Replace the current lands and buildings documents of the projected lands.
+
+    The replaced documents are kept as versions ending at block, like the
+    documents updated by the handlers. The maps changed by the rebuild are
+    stored as checkpoints of the map history at block. In a sharded
+    database, the new documents are stamped with shard, the shard of the
+    lands, so that its invalidations remove them.
+    """
+    chain = {"valid_from": block, "valid_to": None}
+    stamp = {} if shard is None else {"_shard": shard}
+    filter = {"land_id": {"$in": list(projections)}, "_chain.valid_to": None}
+    current = {
+        land["land_id"]: land
+        for land in db["lands"].find(filter, {"land_id": 1, "map": 1, "deltas_since_checkpoint": 1})
+    }
+
+    lands = []
+    changed_maps = {}
+    for land_id, p in projections.items():
+        if p.land is None:
+            continue
+        land = dict(p.land, buildings_grid=buildings_grid(p.buildings), _chain=dict(chain), **stamp)
+        previous = current.get(land_id)
+        if previous is not None and previous["map"] == land["map"]:
+            # the history of the land is still valid
+            land["deltas_since_checkpoint"] = previous.get("deltas_since_checkpoint")
+        else:
+            changed_maps[land_id] = land["map"]
+            land["deltas_since_checkpoint"] = 0
+        lands.append(land)
+    buildings = [
+        dict(building, _chain=dict(chain), **stamp)
+        for p in projections.values()
+        for building in p.buildings
+    ]
+
+    for collection in ["lands", "buildings"]:
+        db[collection].update_many(filter, {"$set": {"_chain.valid_to": block}})
+    if lands:
+        db["lands"].insert_many(lands, ordered=False)
+    if buildings:
+        db["buildings"].insert_many(buildings, ordered=False)
+    write_rebuild_checkpoints(db, changed_maps, block, shard)
+
+
+def rebuild_lands(
+    mongo_url: str,
+    db_name: str,
+    namespace: str,
+    land_ids: List[bytes],
+    to_block: int,
+    shard: Optional[int],
+    dry_run: bool,
+):
+    mongo = MongoClient(mongo_url)
+    try:
+        db = game_database(mongo[db_name], namespace)
+        projections = replay(db, land_ids, to_block)
+        changed = count_changes(db, projections)
+        if not dry_run:
+            write_projections(db, projections, to_block, shard)
+        buildings = sum(len(p.buildings) for p in projections.values())
+        return len(land_ids), buildings, changed
+    finally:
+        mongo.close()
+
+
+def _rebuild_lands(args):
+    return rebuild_lands(*args)
+
+
+def run_rebuild(
+    mongo_url: str, db_name: str, namespace: str = "", workers: int = 1, chunk_size: int = 500, dry_run: bool = False
+):
+    """Rebuild the lands and buildings of the game with namespace.
+
+    In a database indexed with shards, the lands of each shard are rebuilt
+    up to the block of their shard.
+    """
+    from indexer.shards import indexed_shards, land_shard, shard_heights
+
+    db = game_database(MongoClient(mongo_url)[db_name], namespace)
+    count = indexed_shards(db)
+    if count:
+        heights = shard_heights(db, count)
+        missing = [index for index, height in enumerate(heights) if height is None]
+        if missing:
+            raise RuntimeError(f"Shards {missing} of {count} didn't index anything yet, start them first")
+    else:
+        to_block = get_indexed_to(db)
+        if to_block is None:
+            print("Nothing indexed yet.")
+            return
+        heights = [to_block]
+
+    land_ids = set()
+    for collection in ["inits", "resets"]:
+        land_ids.update(db[collection].distinct("land_id", {"_chain.valid_to": None}))
+    groups = [[] for _ in heights]
+    for land_id in sorted(land_ids):
+        groups[land_shard(land_id, count) if count else 0].append(land_id)
+    chunks = [
+        (mongo_url, db_name, namespace, group[i:i + chunk_size], heights[index], index if count else None, dry_run)
+        for index, group in enumerate(groups)
+        for i in range(0, len(group), chunk_size)
+    ]
+    if count:
+        blocks = ", ".join(f"{index}: {height}" for index, height in enumerate(heights))
+        print(f"Rebuilding {len(land_ids)} lands of {count} shards up to their blocks ({blocks}) in {len(chunks)} chunks")
+    else:
+        print(f"Rebuilding {len(land_ids)} lands up to block {heights[0]} in {len(chunks)} chunks")
+
+    if workers > 1:
+        pool = multiprocessing.get_context("spawn").Pool(workers)
+        results = pool.imap_unordered(_rebuild_lands, chunks)
+    else:
+        pool = None
+        results = map(_rebuild_lands, chunks)
+
+    totals = [0, 0, 0]
+    try:
+        for done, result in enumerate(results, 1):
+            totals = [t + r for t, r in zip(totals, result)]
+            print(f"  {done}/{len(chunks)} chunks, {totals[0]} lands, {totals[1]} buildings")
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    verb = "would change" if dry_run else "changed"
+    print(f"Rebuilt {totals[0]} lands and {totals[1]} buildings, {verb} {totals[2]} lands")
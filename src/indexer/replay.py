@@ -0,0 +1,48 @@
+"""Replay safety of the handlers.
+
+Apibara delivers the events at least once: a block can be delivered again,
+with the writes of its first events already stored. The handlers skip what
+they already applied:
+
+- the event documents, the map deltas and the checkpoints have unique keys,
+  `insert_once` ignores the duplicates;
+- the documents updated by the handlers have the position of the last event
+  applied to them in `applied_at`, the handlers skip the documents with a
+  position at or after the event they handle, and the updates filter them
+  out so a retried write doesn't apply twice.
+
+The events are handled in chain order, so a document with the position of an
+event has all the changes of the events before it. When the indexer stops in
+the middle of a block, the writes of that block are invalidated when it
+starts again, before the lands are loaded in memory: the versioned updates
+of apibara are three writes and a stop between them would leave no current
+version of a document.
+"""
+
+from typing import Optional
+
+from pymongo.errors import DuplicateKeyError
+
+
+def event_position(block_number: int, log_index: int) -> int:
+    """Position of an event in the chain, as one int64."""
+    return block_number * 2**32 + log_index
+
+
+def applied(doc: Optional[dict], position: int) -> bool:
+    """Whether doc already has the changes of the event at position."""
+    return doc is not None and doc.get("applied_at", -1) >= position
+
+
+def not_applied(filter: dict, position: int) -> dict:
+    """filter restricted to the documents without the changes of the event at position."""
+    return dict(filter, applied_at={"$not": {"$gte": position}})
+
+
+async def insert_once(info, collection: str, doc: dict) -> bool:
+    """Insert doc, False if a document with its unique key is already stored."""
+    try:
+        await info.storage.insert_one(collection, doc)
+        return True
+    except DuplicateKeyError:
+        return False
@@ -0,0 +1,47 @@
+"""Routing of the events of the game instances, see indexer.games."""
+
+from typing import Dict, List, Tuple
+
+from apibara import Info
+from apibara.model import EventFilter
+
+from indexer.config import get_games
+from indexer.games import GameStorage, check_games, game_events
+
+
+def _address(value) -> int:
+    if isinstance(value, bytes):
+        return int.from_bytes(value, "big")
+    return int(value, 16)
+
+
+class GameRouter:
+    """Routes the events to the instances listening to their contract."""
+
+    def __init__(self, contexts: Dict[str, dict]):
+        check_games()
+        # handler context of each instance, by name
+        self.contexts = contexts
+        self._routes: Dict[Tuple[int, str], List[dict]] = {}
+        for game in get_games():
+            for name, address in game_events(game):
+                self._routes.setdefault((_address(address), name), []).append(game)
+
+    def filters(self) -> List[EventFilter]:
+        """The event filters of all the instances, each once."""
+        filters = []
+        for name, address in dict.fromkeys(e for game in get_games() for e in game_events(game)):
+            filters.append(EventFilter.from_event_name(name=name, address=address))
+        return filters
+
+    def route(self, info: Info, ev) -> List[Info]:
+        """The handler arguments of the instances ev is routed to."""
+        return [
+            self.game_info(info, game)
+            for game in self._routes.get((_address(ev.address), ev.name), [])
+        ]
+
+    def game_info(self, info: Info, game: dict) -> Info:
+        context = self.contexts[game["name"]]
+        storage = GameStorage(info.storage, game["namespace"]) if game["namespace"] else info.storage
+        return Info(context=context, storage=storage)
@@ -0,0 +1,244 @@
+"""Indexing with several processes, each applying the events of some lands.
+
+With `count` shards, the lands are split in `count` ranges of a 64 bits
+hash of their id and shard `index` applies the Frenslands events of the
+lands in its range: the event documents, lands, buildings, statuses,
+activity and map history of its lands. Shard 0 also handles the transfers:
+the tokens, the owners index (including the lands added by `NewGame`) and
+the block headers.
+
+The shards share the indexer database. Each one is an apibara indexer with
+its own id and cursor in `_apibara` and streams all the events. The
+documents written by a shard have its index in `_shard`, so that the
+invalidations of a shard (at startup and on chain reorganizations) only
+touch its documents. The documents are complete up to the lowest block the
+shards indexed, see `db.get_indexed_to`. The resolvers reading the current
+documents directly see the lands of each shard at the block of their shard.
+"""
+
+import asyncio
+import hashlib
+import multiprocessing
+import signal
+import time
+from typing import List, Optional
+
+from apibara import IndexerRunner
+from apibara.indexer.storage import IndexerStorage
+from apibara.model import StarkNetEvent
+from pymongo.database import Database
+
+from indexer.config import indexer_id
+from indexer.db import get_db_name, get_indexed_to
+from indexer.games import frenslands_events, map_events
+from indexer.utils import encode_int_as_bytes, install_uvloop
+
+# position of the land_id felt in the data of the Frenslands events, see the
+# abis of indexer.events
+land_id_offsets = dict.fromkeys(frenslands_events, 1)
+land_id_offsets["ResetGame"] = 2
+
+
+def shard_indexer_id(index: int, count: int) -> str:
+    return f"{indexer_id}-shard-{index}-of-{count}"
+
+
+def land_shard(land_id: bytes, count: int) -> int:
+    """Index of the shard whose hash range has land_id."""
+    digest = hashlib.blake2b(land_id, digest_size=8).digest()
+    return int.from_bytes(digest, "big") * count >> 64
+
+
+def event_land_id(ev: StarkNetEvent) -> bytes:
+    return encode_int_as_bytes(int.from_bytes(ev.data[land_id_offsets[ev.name]], "big"))
+
+
+class Shard:
+    """Shard index of count."""
+
+    def __init__(self, index: int, count: int):
+        if count < 1 or not 0 <= index < count:
+            raise ValueError(f"Invalid shard {index} of {count}, expected 0 to {count - 1}")
+        self.index = index
+        self.count = count
+        self.indexer_id = shard_indexer_id(index, count)
+        # shard handling the transfers, the owners index and the block headers
+        self.tokens = index == 0
+
+    def owns_land(self, land_id: bytes) -> bool:
+        return land_shard(land_id, self.count) == self.index
+
+    def applies(self, ev: StarkNetEvent) -> bool:
+        """Whether the shard applies all of ev."""
+        if ev.name in map_events:
+            return self.tokens
+        return self.owns_land(event_land_id(ev))
+
+
+def handles_tokens(context: dict) -> bool:
+    """Whether the handlers with context maintain the tokens and the owners index."""
+    shard = context.get("shard")
+    return shard is None or shard.tokens
+
+
+def check_shards(db: Database, shard: Optional[Shard]):
+    """Refuse to index a database indexed with another number of shards.
+
+    The lands of a shard depend on the number of shards, and the documents
+    written without shards aren't invalidated by them.
+    """
+    if shard is None:
+        expected = [indexer_id]
+    else:
+        expected = [shard_indexer_id(index, shard.count) for index in range(shard.count)]
+    others = [id for id in db["_apibara"].distinct("indexer_id") if id not in expected]
+    if others:
+        raise RuntimeError(
+            f"The database was indexed by {others}, start with the same shards or --restart"
+        )
+
+
+class ShardStorage:
+    """The apibara storage of a block, stamping the documents written with the shard."""
+
+    def __init__(self, storage, shard: Shard):
+        self.storage = storage
+        self.shard = shard
+
+    # documents are stamped in place, like apibara adds their _chain
+    async def insert_one(self, collection: str, doc: dict):
+        doc["_shard"] = self.shard.index
+        return await self.storage.insert_one(collection, doc)
+
+    async def insert_many(self, collection: str, docs: List[dict]):
+        for doc in docs:
+            doc["_shard"] = self.shard.index
+        return await self.storage.insert_many(collection, docs)
+
+    async def find_one_and_replace(self, collection: str, filter: dict, replacement: dict, upsert: bool = False):
+        replacement["_shard"] = self.shard.index
+        return await self.storage.find_one_and_replace(collection, filter, replacement, upsert)
+
+    async def find_one_and_update(self, collection: str, filter: dict, update: dict):
+        # the new version is a copy of the current one, stamped as well
+        update = dict(update)
+        update["$set"] = dict(update.get("$set", {}), _shard=self.shard.index)
+        return await self.storage.find_one_and_update(collection, filter, update)
+
+    def __getattr__(self, name: str):
+        return getattr(self.storage, name)
+
+
+class ShardIndexerStorage(IndexerStorage):
+    """The apibara state of a shard, in the database shared by the shards."""
+
+    def __init__(self, url: Optional[str], shard: Shard):
+        super().__init__(url, shard.indexer_id)
+        self.db_name = get_db_name(indexer_id)
+        self.db = self._mongo[self.db_name]
+        self.shard = shard
+
+    def invalidate(self, block_number: int):
+        """Invalidates the documents of the shard written in `block_number` and later."""
+        with self._mongo.start_session() as session:
+            for name in self.db.list_collection_names(session=session):
+                if name.startswith("_"):
+                    continue
+                self.db[name].delete_many(
+                    {"_shard": self.shard.index, "_chain.valid_from": {"$gte": block_number}},
+                    session=session,
+                )
+                self.db[name].update_many(
+                    {"_shard": self.shard.index, "_chain.valid_to": {"$gte": block_number}},
+                    {"$set": {"_chain.valid_to": None}},
+                    session=session,
+                )
+
+    def drop_database(self):
+        raise RuntimeError("The database is shared by the shards, drop it before starting them")
+
+
+class ShardRunner(IndexerRunner):
+    """IndexerRunner of a shard."""
+
+    def __init__(self, *, shard: Shard, **kwargs):
+        super().__init__(indexer_id=shard.indexer_id, **kwargs)
+        self._indexer_storage = ShardIndexerStorage(self._config.storage_url, shard)
+
+
+# Coordinator
+
+def shard_heights(db: Database, count: int) -> List[Optional[int]]:
+    """Last block indexed by each of the count shards, None when not started."""
+    return [get_indexed_to(db, shard_indexer_id(index, count)) for index in range(count)]
+
+
+def indexed_shards(db: Database) -> int:
+    """Number of shards the database was indexed with, 0 without shards."""
+    prefix = f"{indexer_id}-shard-"
+    counts = {
+        int(id.rsplit("-of-", 1)[1])
+        for id in db["_apibara"].distinct("indexer_id")
+        if id.startswith(prefix)
+    }
+    if len(counts) > 1:
+        raise RuntimeError(f"The database was indexed with {sorted(counts)} shards, index it again with --restart")
+    return counts.pop() if counts else 0
+
+
+def report_heights(db: Database, count: int):
+    heights = shard_heights(db, count)
+    indexed = [height for height in heights if height is not None]
+    lowest = min(indexed) if len(indexed) == count else None
+    shards = ", ".join(f"{index}: {height}" for index, height in enumerate(heights))
+    print(f"Indexed to block {lowest} (shards {shards})")
+
+
+def run_shard(mongo_url: str, count: int, index: int, use_uvloop: bool, options: dict):
+    from indexer.indexer import run_indexer
+
+    # spawned processes don't inherit the event loop policy
+    if use_uvloop:
+        install_uvloop()
+    asyncio.run(run_indexer(mongo_url=mongo_url, shard=Shard(index, count), **options))
+
+
+def run_shards(db: Database, mongo_url: str, count: int, interval: float = 10, use_uvloop: bool = False, **options):
+    """Run the count shards in local processes and report their lowest indexed block.
+
+    `options` are passed to `run_indexer` in each shard. A shard that stopped
+    is started again, SIGTERM and SIGINT stop all of them.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    state = {"stop": False}
+
+    def on_stop(_signum, _frame):
+        state["stop"] = True
+
+    signal.signal(signal.SIGTERM, on_stop)
+    signal.signal(signal.SIGINT, on_stop)
+
+    def start(index: int):
+        process = ctx.Process(
+            target=run_shard, args=(mongo_url, count, index, use_uvloop, options), name=f"indexer-shard-{index}"
+        )
+        process.start()
+        return process
+
+    processes = [start(index) for index in range(count)]
+    last_report = 0.0
+    while not state["stop"]:
+        time.sleep(1)
+        for index, process in enumerate(processes):
+            if not process.is_alive() and not state["stop"]:
+                print(f"Shard {index} stopped with code {process.exitcode}, starting it again")
+                processes[index] = start(index)
+        if time.time() - last_report >= interval:
+            report_heights(db, count)
+            last_report = time.time()
+
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
+    report_heights(db, count)
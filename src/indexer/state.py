@@ -0,0 +1,158 @@
+"""State logic of the lands and buildings, shared by the event handlers and
+the projection rebuild.
+
+The functions only compute documents and updates, they don't read or write
+the database. Positions are 1-based like in the events.
+"""
+
+from datetime import datetime
+from typing import Iterable, List
+
+from indexer.utils import create_map_array, encode_int_as_bytes
+
+# the cabin every land starts with
+CABIN_TYPE_ID = 1
+CABIN_UID = 1
+CABIN_BLOCK_COMP = 20100011199
+CABIN_POS = (20, 8)
+
+# size of the maps
+MAP_WIDTH = 40
+MAP_HEIGHT = 16
+
+
+def new_land(land_id: bytes, time: bytes, transaction_hash: bytes, block_time: datetime) -> dict:
+    return {
+        "map": create_map_array(),
+        "land_id": land_id,
+        "transaction_hash": transaction_hash,
+        "time": time,
+        "timestamp": block_time,
+        "updated_at": block_time,
+        "buildings_grid": new_buildings_grid(),
+        # see indexer.history
+        "deltas_since_checkpoint": 0,
+    }
+
+
+def new_cabin(
+    owner: bytes,
+    land_id: bytes,
+    time: bytes,
+    last_fuel: int,
+    transaction_hash: bytes,
+    block_time: datetime,
+) -> dict:
+    return {
+        "owner": owner,
+        "land_id": land_id,
+        "time": time,
+        "building_type_id": encode_int_as_bytes(CABIN_TYPE_ID),
+        "building_uid": encode_int_as_bytes(CABIN_UID),
+        "block_comp": encode_int_as_bytes(CABIN_BLOCK_COMP),
+        "pos_x": encode_int_as_bytes(CABIN_POS[0]),
+        "pos_y": encode_int_as_bytes(CABIN_POS[1]),
+        "transaction_hash": transaction_hash,
+        "timestamp": block_time,
+        "status": "built",
+        "decay": 100,
+        "active_cycles": 0,
+        "incoming_cycles": 0,
+        "last_fuel": last_fuel,
+        "updated_at": block_time,
+    }
+
+
+def new_building(build: dict) -> dict:
+    """Building created by a Build event document."""
+    building_type_id = int.from_bytes(build["building_type_id"], "big")
+    return {
+        "owner": build["owner"],
+        "land_id": build["land_id"],
+        "time": build["time"],
+        "building_type_id": build["building_type_id"],
+        "building_uid": build["building_uid"],
+        "block_comp": build["block_comp"],
+        "pos_x": build["pos_x"],
+        "pos_y": build["pos_y"],
+        "transaction_hash": build["transaction_hash"],
+        "timestamp": build["timestamp"],
+        "status": "built",
+        "decay": 0,
+        "active_cycles": 0,
+        # the first cycle of the producing buildings is already paid
+        "incoming_cycles": 1 if building_type_id > 2 else 0,
+        "last_fuel": int.from_bytes(build["time"], "big"),
+        "updated_at": build["timestamp"],
+    }
+
+
+def fuel_cycles(building: dict, time: int, nb_blocks: int) -> dict:
+    """Cycle fields of building after a FuelProduction of nb_blocks at time."""
+    active_cycles = building["active_cycles"]
+    incoming_cycles = building["incoming_cycles"]
+
+    if incoming_cycles == 0:
+        incoming_cycles = nb_blocks
+    else:
+        passed_blocks = time - building["last_fuel"]
+        if incoming_cycles <= passed_blocks:
+            active_cycles += incoming_cycles
+            incoming_cycles = nb_blocks
+        else:
+            active_cycles += passed_blocks
+            incoming_cycles = incoming_cycles - passed_blocks + nb_blocks
+
+    return {
+        "active_cycles": active_cycles,
+        "incoming_cycles": incoming_cycles,
+        "last_fuel": time,
+    }
+
+
+def claim_cycles(building: dict, block_number: int) -> dict:
+    """Cycle fields of building after a Claim at block_number."""
+    incoming_cycles = building["incoming_cycles"]
+    if incoming_cycles != 0:
+        passed_blocks = block_number - building["last_fuel"]
+        if incoming_cycles <= passed_blocks:
+            incoming_cycles = 0
+        else:
+            incoming_cycles = incoming_cycles - passed_blocks
+
+    return {
+        "active_cycles": 0,
+        "incoming_cycles": incoming_cycles,
+        "last_fuel": block_number,
+    }
+
+
+def set_cell(map: List[List[int]], pos_x: int, pos_y: int, value: int):
+    map[pos_y - 1][pos_x - 1] = value
+
+
+def move_cell(map: List[List[int]], pos_x: int, pos_y: int, new_pos_x: int, new_pos_y: int):
+    map[new_pos_y - 1][new_pos_x - 1] = map[pos_y - 1][pos_x - 1]
+    map[pos_y - 1][pos_x - 1] = 0
+
+
+def new_buildings_grid() -> List[List[int]]:
+    """Uid of the building on each cell of a new land, 0 on free cells."""
+    grid = [[0] * MAP_WIDTH for _ in range(MAP_HEIGHT)]
+    set_cell(grid, CABIN_POS[0], CABIN_POS[1], CABIN_UID)
+    return grid
+
+
+def buildings_grid(buildings: Iterable[dict]) -> List[List[int]]:
+    """Uid of the building on each cell, from the buildings documents."""
+    grid = [[0] * MAP_WIDTH for _ in range(MAP_HEIGHT)]
+    for building in buildings:
+        if building.get("status") == "destroyed":
+            continue
+        set_cell(
+            grid,
+            int.from_bytes(building["pos_x"], "big"),
+            int.from_bytes(building["pos_y"], "big"),
+            int.from_bytes(building["building_uid"], "big"),
+        )
+    return grid
@@ -0,0 +1,106 @@
+from typing import Dict, Optional
+
+from pymongo.database import Database
+
+from indexer.db import get_indexed_to, get_reorgs
+from indexer.replay import applied
+
+
+# Lifecycle of the lands: one document per land, updated on NewGame and ResetGame
+async def update_land_status(
+    info, land_id: bytes, owner: bytes, block_time, position: int, reset_block: Optional[int] = None
+):
+    existing = await info.storage.find_one("land_status", {"land_id": land_id})
+    if applied(existing, position):
+        return
+    last_reset = reset_block
+    if last_reset is None and existing is not None:
+        last_reset = existing["last_reset"]
+
+    await info.storage.find_one_and_replace(
+        "land_status",
+        {"land_id": land_id},
+        {
+            "land_id": land_id,
+            "initialized": True,
+            "owner": owner,
+            "last_reset": last_reset,
+            "updated_at": block_time,
+            "applied_at": position,
+        },
+        upsert=True,
+    )
+
+
+class InitializedLands:
+    """In-memory set of the initialized land ids, used by the GraphQL server.
+
+    `refresh` only reads the status documents written since the previous call,
+    the whole set is reloaded when the indexer recorded a chain reorganization
+    in `_reorgs` or rolled back blocks.
+    """
+
+    def __init__(self, db: Database):
+        self._db = db
+        self._lands = set()
+        self._synced_to = -1
+        self._indexed_to = None
+        # number of reorganizations of each indexer at the last load
+        self._reorgs = {}
+
+    def __contains__(self, land_id: bytes) -> bool:
+        return land_id in self._lands
+
+    def __len__(self) -> int:
+        return len(self._lands)
+
+    @property
+    def indexed_to(self) -> Optional[int]:
+        """Last indexed block seen by the last refresh."""
+        return self._indexed_to
+
+    def load(self):
+        # read first, a reorganization recorded while loading reloads again
+        self._reorgs = self._get_reorgs()
+        lands = set()
+        # lands indexed before the status documents existed
+        for collection in ["inits", "resets"]:
+            lands.update(self._db[collection].distinct("land_id", {"_chain.valid_to": None}))
+        self._lands = lands
+        self._synced_to = -1
+        self._indexed_to = self._get_indexed_to()
+        self._sync()
+
+    def refresh(self):
+        reorgs = self._get_reorgs()
+        indexed_to = self._get_indexed_to()
+        reorganized = any(count > self._reorgs.get(id, 0) for id, count in reorgs.items())
+        if reorganized or (self._indexed_to is not None and indexed_to is not None and indexed_to < self._indexed_to):
+            # chain reorganization, possibly already indexed again to the same
+            # block: some lands may not be initialized anymore
+            self.load()
+            return
+        self._indexed_to = indexed_to
+        self._sync()
+
+    def _sync(self):
+        # only read fully indexed blocks
+        if self._indexed_to is None or self._indexed_to <= self._synced_to:
+            return
+        query = self._db["land_status"].find(
+            {
+                "_chain.valid_to": None,
+                "_chain.valid_from": {"$gt": self._synced_to, "$lte": self._indexed_to},
+            },
+            {"land_id": 1, "initialized": 1},
+        )
+        for status in query:
+            if status["initialized"]:
+                self._lands.add(status["land_id"])
+        self._synced_to = self._indexed_to
+
+    def _get_indexed_to(self) -> Optional[int]:
+        return get_indexed_to(self._db)
+
+    def _get_reorgs(self) -> Dict[str, int]:
+        return {id: doc["count"] for id, doc in get_reorgs(self._db).items()}
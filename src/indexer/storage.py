@@ -0,0 +1,240 @@
+"""Storage of the append-only event collections.
+
+By default each event is a document of its collection, versioned by apibara
+like the others. The collections of `config.bucketed_collections` are instead
+stored in `<collection>_buckets`, one document per land (token for the
+transfers) and range of `config.bucket_blocks` blocks:
+
+    {
+        "land_id": <32 bytes>,
+        "start_block": 1000,
+        "end_block": 2000,
+        "min_timestamp": ..., "max_timestamp": ...,
+        "events": [{"block": 1042, "log_index": 3, "time": 1234, ...}],
+    }
+
+Small felts are stored as integers and the land id once per bucket. The
+buckets are written outside of apibara, so events invalidated by a chain
+reorganization are pulled by `invalidate_buckets`.
+
+`find_events` reads both layouts and returns documents shaped like the
+documents of the plain collections.
+"""
+
+from typing import Iterator, List, Optional
+
+from pymongo import ASCENDING
+from pymongo.database import Database
+from pymongo.errors import DuplicateKeyError
+
+from indexer.config import bucket_blocks, bucketed_collections
+from indexer.db import event_int_fields
+from indexer.replay import insert_once
+
+# field identifying the buckets of each collection
+bucket_keys = {collection: "land_id" for collection in event_int_fields}
+bucket_keys["transfers"] = "token_id"
+
+# sort fields of the plain collections, the buckets are sorted by position
+# in the chain instead
+_block_fields = ("_chain.valid_from", "timestamp", "updated_at")
+
+_max_int64 = 2**63 - 1
+
+
+def is_bucketed(collection: str) -> bool:
+    return collection in bucketed_collections
+
+
+def bucket_collection(collection: str) -> str:
+    return f"{collection}_buckets"
+
+
+def create_bucket_indexes(db: Database):
+    for collection in bucketed_collections:
+        db[bucket_collection(collection)].create_index(
+            [(bucket_keys[collection], ASCENDING), ("start_block", ASCENDING)], unique=True
+        )
+        # range scans of all the lands, e.g. by the export
+        db[bucket_collection(collection)].create_index([("end_block", ASCENDING)])
+
+
+def _encode(collection: str, name: str, value):
+    if name in event_int_fields[collection] and isinstance(value, bytes):
+        value = int.from_bytes(value, "big")
+        if value > _max_int64:
+            return value.to_bytes(32, "big")
+    return value
+
+
+def _decode(collection: str, name: str, value):
+    if name in event_int_fields[collection] and isinstance(value, int):
+        return value.to_bytes(32, "big")
+    return value
+
+
+def to_bucket_event(collection: str, block_number: int, log_index: int, doc: dict) -> dict:
+    key = bucket_keys[collection]
+    event = {"block": block_number, "log_index": log_index}
+    for name, value in doc.items():
+        if name != key:
+            event[name] = _encode(collection, name, value)
+    return event
+
+
+def from_bucket_event(collection: str, key_value: bytes, event: dict) -> dict:
+    doc = {bucket_keys[collection]: key_value}
+    for name, value in event.items():
+        if name != "block":
+            doc[name] = _decode(collection, name, value)
+    doc["_chain"] = {"valid_from": event["block"], "valid_to": None}
+    return doc
+
+
+async def insert_events(info, collection: str, block_number: int, docs: List[dict], log_index: int):
+    """Store the documents of the events of a StarkNet event, once."""
+    if not is_bucketed(collection):
+        # unique by transaction_hash and log_index, see db.create_indexes
+        for doc in docs:
+            await insert_once(info, collection, dict(doc, log_index=log_index))
+        return
+
+    db = info.context["db"]
+    key = bucket_keys[collection]
+    start = block_number - block_number % bucket_blocks
+    on_insert = {"end_block": start + bucket_blocks}
+    # the buckets of a land are written by its shard, see indexer.shards
+    if info.context.get("shard") is not None:
+        on_insert["_shard"] = info.context["shard"].index
+    for doc in docs:
+        event = to_bucket_event(collection, block_number, log_index, doc)
+        try:
+            db[bucket_collection(collection)].update_one(
+                {
+                    key: doc[key],
+                    "start_block": start,
+                    # blocks indexed again after a restart don't add the events twice
+                    "events": {"$not": {"$elemMatch": {"block": block_number, "log_index": log_index}}},
+                },
+                {
+                    "$push": {"events": event},
+                    "$setOnInsert": on_insert,
+                    "$min": {"min_timestamp": doc["timestamp"]},
+                    "$max": {"max_timestamp": doc["timestamp"]},
+                },
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # the bucket exists and already has the event
+            pass
+
+
+def invalidate_buckets(db: Database, block_number: int, shard: Optional[int] = None):
+    """Remove the events of the blocks from block_number, of the buckets of shard if set."""
+    filter = {"end_block": {"$gt": block_number}}
+    if shard is not None:
+        filter["_shard"] = shard
+    for collection in bucketed_collections:
+        buckets = db[bucket_collection(collection)]
+        buckets.update_many(filter, {"$pull": {"events": {"block": {"$gte": block_number}}}})
+        buckets.delete_many(dict(filter, events={"$size": 0}))
+
+
+def _block_range(condition) -> dict:
+    """Filter of the buckets that may contain blocks matching condition."""
+    if not isinstance(condition, dict):
+        return {"start_block": {"$lte": condition}, "end_block": {"$gt": condition}}
+    filter = {}
+    for op, value in condition.items():
+        if op == "$gt":
+            filter["end_block"] = {"$gt": value + 1}
+        elif op == "$gte":
+            filter["end_block"] = {"$gt": value}
+        elif op == "$lt":
+            filter["start_block"] = {"$lt": value}
+        elif op == "$lte":
+            filter["start_block"] = {"$lte": value}
+    return filter
+
+
+def _time_range(condition) -> dict:
+    if not isinstance(condition, dict):
+        return {"min_timestamp": {"$lte": condition}, "max_timestamp": {"$gte": condition}}
+    filter = {}
+    for op, value in condition.items():
+        if op in ("$gt", "$gte"):
+            filter["max_timestamp"] = {op: value}
+        elif op in ("$lt", "$lte"):
+            filter["min_timestamp"] = {op: value}
+    return filter
+
+
+def _bucket_pipeline(collection: str, filter: dict, direction: int, skip: int, limit: int) -> list:
+    key = bucket_keys[collection]
+    bucket_filter = {}
+    event_filter = {}
+    for name, condition in filter.items():
+        if name == "_chain.valid_to":
+            # buckets only have the current events
+            continue
+        if name == key:
+            bucket_filter[key] = condition
+        elif name == "_chain.valid_from":
+            bucket_filter.update(_block_range(condition))
+            event_filter["events.block"] = condition
+        elif name == "timestamp":
+            bucket_filter.update(_time_range(condition))
+            event_filter["events.timestamp"] = condition
+        else:
+            event_filter[f"events.{name}"] = _encode(collection, name, condition)
+
+    pipeline = [{"$match": bucket_filter}, {"$unwind": "$events"}]
+    if event_filter:
+        pipeline.append({"$match": event_filter})
+    pipeline.append({"$sort": {"events.block": direction, "events.log_index": direction}})
+    if skip:
+        pipeline.append({"$skip": skip})
+    if limit:
+        pipeline.append({"$limit": limit})
+    pipeline.append({"$project": {"_id": 0, key: 1, "events": 1}})
+    return pipeline
+
+
+def find_events(
+    db: Database,
+    collection: str,
+    filter: dict,
+    sort: Optional[list] = None,
+    skip: int = 0,
+    limit: int = 0,
+    projection: Optional[dict] = None,
+    batch_size: int = 0,
+) -> Iterator[dict]:
+    """Find the events of collection, with a filter written for the plain collection.
+
+    With buckets, the filter can use equality on any field and ranges on
+    `_chain.valid_from` and `timestamp`, documents are sorted by position in
+    the chain in the direction of the first sort field.
+    """
+    if not is_bucketed(collection):
+        cursor = db[collection].find(filter, projection, batch_size=batch_size).skip(skip).limit(limit)
+        if sort:
+            cursor = cursor.sort(sort)
+        return cursor
+
+    direction = sort[0][1] if sort else ASCENDING
+    if sort and sort[0][0] not in _block_fields:
+        raise ValueError(f"Cannot sort the buckets of {collection} by {sort[0][0]}")
+    cursor = db[bucket_collection(collection)].aggregate(
+        _bucket_pipeline(collection, filter, direction, skip, limit),
+        allowDiskUse=True,
+        batchSize=batch_size or None,
+    )
+    key = bucket_keys[collection]
+    return (from_bucket_event(collection, row[key], row["events"]) for row in cursor)
+
+
+def find_one_event(db: Database, collection: str, filter: dict, sort: Optional[list] = None):
+    for doc in find_events(db, collection, filter, sort, limit=1):
+        return doc
+    return None
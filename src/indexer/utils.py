@@ -1,4 +1,5 @@
 
+import asyncio
 from typing import List
 
 uint256_abi = {
@@ -13,8 +14,6 @@ uint256_abi = {
 
 def encode_int_as_bytes(n: int) -> bytes:
     """Encode an integer to bytes so that it can be stored in a db."""
-    data = n.to_bytes(32, "big")
-    print(data)
     return n.to_bytes(32, "big")
 
 def create_map_array() -> List[List[int]]:
@@ -27,4 +26,11 @@ def create_map_array() -> List[List[int]]:
     num_cols = 40
 
     map_array = [[map_elements[num_cols * r + c] for c in range(num_cols)] for r in range(num_rows)]
-    return map_array
\ No newline at end of file
+    return map_array
+
+
+def install_uvloop():
+    """Use uvloop for the event loops created from now on."""
+    import uvloop
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
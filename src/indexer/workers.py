@@ -0,0 +1,202 @@
+"""Run the GraphQL server in several processes sharing the same port."""
+
+import asyncio
+import multiprocessing
+import signal
+import time
+from typing import List
+
+from aiohttp import ClientSession
+
+from indexer.graphql import run_graphql_api
+from indexer.utils import install_uvloop
+
+
+def run_worker(mongo_url, port, heartbeat, ready, use_uvloop, options):
+    # spawned processes don't inherit the event loop policy
+    if use_uvloop:
+        install_uvloop()
+    asyncio.run(
+        run_graphql_api(
+            mongo_url=mongo_url, port=port, reuse_port=True, heartbeat=heartbeat, ready=ready, **options
+        )
+    )
+
+
+class Worker:
+    """A GraphQL server process, listening with SO_REUSEPORT."""
+
+    def __init__(self, ctx, index, mongo_url, port, use_uvloop, options):
+        self.index = index
+        self.started_at = time.time()
+        # updated by the worker event loop every few seconds, also while the
+        # worker loads its in-memory copies
+        self.heartbeat = ctx.Value("d", 0.0)
+        # set once the worker listens, after loading
+        self.ready = ctx.Value("b", 0)
+        self.process = ctx.Process(
+            target=run_worker,
+            args=(mongo_url, port, self.heartbeat, self.ready, use_uvloop, options),
+            name=f"graphql-worker-{index}",
+        )
+        self.process.start()
+
+    def is_ready(self) -> bool:
+        return bool(self.ready.value)
+
+    def is_healthy(self, timeout: float) -> bool:
+        if not self.process.is_alive():
+            return False
+        last_seen = self.heartbeat.value or self.started_at
+        return time.time() - last_seen < timeout
+
+    def stop(self, timeout: float):
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+
+def run_graphql_workers(
+    mongo_url=None,
+    workers=2,
+    port=8080,
+    heartbeat_timeout=30,
+    stop_timeout=30,
+    use_uvloop=False,
+    **options,
+):
+    """Start `workers` servers and keep them running.
+
+    - a worker that died or whose event loop is stuck is replaced,
+    - SIGHUP restarts the workers one by one, waiting for the new one to be ready,
+    - SIGTERM and SIGINT stop all the workers gracefully.
+
+    `options` are passed to `run_graphql_api` in each worker.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    state = {"stop": False, "restart": False}
+
+    def on_stop(_signum, _frame):
+        state["stop"] = True
+
+    def on_restart(_signum, _frame):
+        state["restart"] = True
+
+    signal.signal(signal.SIGTERM, on_stop)
+    signal.signal(signal.SIGINT, on_stop)
+    signal.signal(signal.SIGHUP, on_restart)
+
+    pool = [Worker(ctx, i, mongo_url, port, use_uvloop, options) for i in range(workers)]
+    print(f"Started {workers} GraphQL workers on port {port}")
+
+    while not state["stop"]:
+        time.sleep(1)
+
+        if state["restart"]:
+            state["restart"] = False
+            print("Restarting GraphQL workers")
+            for i, old in enumerate(pool):
+                new = Worker(ctx, i, mongo_url, port, use_uvloop, options)
+                while not new.is_ready() and new.is_healthy(heartbeat_timeout) and not state["stop"]:
+                    time.sleep(0.1)
+                if not new.is_ready():
+                    # keep the old worker serving
+                    print(f"GraphQL worker {i} failed to start, keeping pid {old.process.pid}")
+                    new.stop(stop_timeout)
+                    continue
+                old.stop(stop_timeout)
+                pool[i] = new
+
+        for i, worker in enumerate(pool):
+            if state["stop"] or worker.is_healthy(heartbeat_timeout):
+                continue
+            print(f"GraphQL worker {i} (pid {worker.process.pid}) is unhealthy, replacing it")
+            worker.stop(stop_timeout)
+            pool[i] = Worker(ctx, i, mongo_url, port, use_uvloop, options)
+
+    print("Stopping GraphQL workers")
+    for worker in pool:
+        worker.stop(stop_timeout)
+
+
+# Benchmark
+
+# the lands served from Mongo, most of the time is spent building and
+# encoding the response
+BENCHMARK_QUERY = "{ getLand(landId: null, limit: 10) { landId mapGrid } }"
+
+
+async def send_queries(url: str, query: str, count: int, concurrency: int) -> List[float]:
+    """Latencies of count posts of query, concurrency at a time."""
+    latencies = []
+    remaining = iter(range(count))
+
+    async def client(session):
+        for _ in remaining:
+            start = time.perf_counter()
+            async with session.post(url, json={"query": query}) as response:
+                body = await response.json()
+            if response.status != 200 or body.get("errors"):
+                raise RuntimeError(f"Query failed with status {response.status}: {body.get('errors')}")
+            latencies.append(time.perf_counter() - start)
+
+    async with ClientSession() as session:
+        await asyncio.gather(*(client(session) for _ in range(concurrency)))
+    return latencies
+
+
+def _send_queries(args):
+    return asyncio.run(send_queries(*args))
+
+
+def run_benchmark(
+    mongo_url,
+    workers=(1, 4),
+    port=8090,
+    query=BENCHMARK_QUERY,
+    requests=5_000,
+    concurrency=32,
+    clients=2,
+    use_uvloop=False,
+    startup_timeout=120,
+    **options,
+):
+    """Throughput and latencies of query against servers with each number of workers.
+
+    The servers are started like `run_graphql_workers` and loaded by
+    `clients` processes sending `concurrency` queries at a time each, after
+    a warm up. `options` are passed to `run_graphql_api` in each worker.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    url = f"http://127.0.0.1:{port}/graphql"
+    rates = []
+    print(f"Sending {requests} queries from {clients} clients to {', '.join(map(str, workers))} workers: {query}")
+    for count in workers:
+        pool = [Worker(ctx, i, mongo_url, port, use_uvloop, options) for i in range(count)]
+        try:
+            started = time.time()
+            while not all(worker.is_ready() for worker in pool):
+                if time.time() - started > startup_timeout or not all(worker.process.is_alive() for worker in pool):
+                    raise RuntimeError(f"The {count} GraphQL workers didn't start")
+                time.sleep(0.1)
+            asyncio.run(send_queries(url, query, concurrency * 10, concurrency))
+
+            start = time.perf_counter()
+            with ctx.Pool(clients) as client_pool:
+                args = [(url, query, requests // clients, concurrency)] * clients
+                latencies = sorted(sum(client_pool.map(_send_queries, args), []))
+            elapsed = time.perf_counter() - start
+        finally:
+            for worker in pool:
+                worker.stop(30)
+
+        rates.append(len(latencies) / elapsed)
+        p50 = latencies[len(latencies) // 2] * 1000
+        p99 = latencies[int(len(latencies) * 0.99)] * 1000
+        print(
+            f"  {count} workers: {rates[-1]:.0f} requests/s ({rates[-1] / rates[0]:.2f}x), "
+            f"p50 {p50:.1f} ms, p99 {p99:.1f} ms"
+        )
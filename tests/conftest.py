@@ -0,0 +1,135 @@
+"""Fixtures running the event handlers on mongomock, without Apibara.
+
+The handlers get a stub `Info` with the apibara `Storage` of the block, on a
+mongomock database with the indexes of `create_indexes`.
+"""
+
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import mongomock
+import pytest
+from apibara.indexer.storage import Storage
+
+from indexer.config import indexer_id
+from indexer.db import create_indexes
+from indexer.events.build import handle_build_events
+from indexer.events.claim import handle_claim_events
+from indexer.events.destroy import handle_destroy_events
+from indexer.events.fuel import handle_fuel_events
+from indexer.events.harvest import handle_harvest_events
+from indexer.events.init import handle_init_events, handle_reset_events
+from indexer.events.move import handle_move_events
+from indexer.events.repair import handle_repair_events
+from indexer.events.transfers import handle_transfer_events
+
+START_TIME = datetime(2022, 10, 1, 10, 5)
+
+
+def felt(value: int) -> bytes:
+    return value.to_bytes(32, "big")
+
+
+def scenario():
+    """(handler, block, log_index, data) of two lands played from their mint to a reset."""
+    events = []
+    for land in (1, 2):
+        events += [
+            (handle_transfer_events, 9, [0, 7, land, 0]),
+            (handle_init_events, 10, [7, land, 100]),
+            (handle_build_events, 11, [7, land, 101, 3, 2, 10300021199, 5, 5]),
+            (handle_build_events, 11, [7, land, 101, 4, 3, 10400031199, 6, 6]),
+            (handle_fuel_events, 12, [7, land, 105, 3, 2, 5, 5, 20]),
+            (handle_harvest_events, 13, [7, land, 106, 1, 9, 10100091199, 3, 3]),
+            (handle_fuel_events, 14, [7, land, 130, 3, 2, 5, 5, 10]),
+            (handle_claim_events, 15, [7, land, 131, 140, 2]),
+            (handle_move_events, 16, [7, land, 132, 1, 4, 3, 6, 6, 7, 7]),
+            (handle_repair_events, 17, [7, land, 133, 1, 1, 20, 8]),
+            (handle_destroy_events, 18, [7, land, 134, 3, 2, 10300021199, 5, 5]),
+            (handle_transfer_events, 18, [7, 8, land, 0]),
+        ]
+    events += [
+        (handle_reset_events, 19, [8, 140, 2]),
+        (handle_build_events, 20, [8, 2, 141, 3, 5, 10300051199, 1, 1]),
+    ]
+    events.sort(key=lambda event: event[1])
+    return [(handler, block, log_index, data) for log_index, (handler, block, data) in enumerate(events)]
+
+
+class Indexer:
+    """The handlers of the scenario events applied to db, like apibara does."""
+
+    def __init__(self, db, live=None):
+        self.db = db
+        self.live = live
+        self.events = scenario()
+        self.blocks = sorted({block for _, block, _, _ in self.events})
+
+    def info(self, block: int, storage=None):
+        context = {"db": self.db, "live": self.live}
+        return SimpleNamespace(context=context, storage=storage or Storage(self.db, None, block))
+
+    def handle(self, handler, block: int, log_index: int, data, storage=None):
+        header = SimpleNamespace(number=block, timestamp=START_TIME + timedelta(minutes=block))
+        ev = SimpleNamespace(data=[felt(x) for x in data], transaction_hash=felt(1000 + log_index), log_index=log_index)
+        asyncio.run(handler(self.info(block, storage), header, ev))
+
+    def handle_block(self, block: int):
+        if self.live is not None:
+            self.live.begin_block(block)
+        for handler, event_block, log_index, data in self.events:
+            if event_block == block:
+                self.handle(handler, block, log_index, data)
+        self.db["_apibara"].update_one({"indexer_id": indexer_id}, {"$set": {"indexed_to": block}}, upsert=True)
+
+    def handle_blocks(self, first: int = 0, last: int = 2**31):
+        for block in self.blocks:
+            if first <= block <= last:
+                self.handle_block(block)
+
+    def invalidate(self, block: int):
+        """The writes of block and later discarded, like `IndexerStorage.invalidate`.
+
+        mongomock doesn't implement the `list_collections` of apibara.
+        """
+        for name in self.db.list_collection_names():
+            if name.startswith("_"):
+                continue
+            self.db[name].delete_many({"_chain.valid_from": {"$gte": block}})
+            self.db[name].update_many({"_chain.valid_to": {"$gte": block}}, {"$set": {"_chain.valid_to": None}})
+
+
+def current_documents(db) -> dict:
+    """The current version of the documents of each collection written by the handlers."""
+    state = {}
+    for name in sorted(db.list_collection_names()):
+        if name.startswith("_"):
+            continue
+        docs = []
+        for doc in db[name].find({"_chain.valid_to": None}):
+            doc.pop("_id")
+            doc.pop("_chain")
+            docs.append(repr(sorted(doc.items())))
+        state[name] = sorted(docs)
+    return state
+
+
+def live_copies(live, land_ids) -> dict:
+    return {land_id: live.land(land_id) for land_id in land_ids}
+
+
+@pytest.fixture
+def db():
+    db = mongomock.MongoClient().db
+    create_indexes(db)
+    return db
+
+
+@pytest.fixture
+def reference():
+    """The documents written by the scenario, each block handled once."""
+    db = mongomock.MongoClient().db
+    create_indexes(db)
+    Indexer(db).handle_blocks()
+    return current_documents(db)
@@ -0,0 +1,136 @@
+import asyncio
+
+import pytest
+from apibara.indexer.storage import Storage
+
+from indexer.config import indexer_id
+from indexer.indexer import unfinished_block
+from indexer.live import LiveCache
+from indexer.replay import applied, event_position, insert_once, not_applied
+
+from conftest import Indexer, current_documents, felt, live_copies
+
+LAND_IDS = [felt(1), felt(2)]
+
+
+class Crash(Exception):
+    pass
+
+
+class CrashingStorage(Storage):
+    """Storage of a block stopping the indexer after a number of writes."""
+
+    def __init__(self, db, block: int, writes: int):
+        super().__init__(db, None, block)
+        self.writes = writes
+
+    def _write(self):
+        self.writes -= 1
+        if self.writes < 0:
+            raise Crash()
+
+    async def insert_one(self, collection, doc):
+        self._write()
+        return await super().insert_one(collection, doc)
+
+    async def insert_many(self, collection, docs):
+        self._write()
+        return await super().insert_many(collection, docs)
+
+    async def find_one_and_update(self, collection, filter, update):
+        self._write()
+        return await super().find_one_and_update(collection, filter, update)
+
+    async def find_one_and_replace(self, collection, filter, replacement, upsert=False):
+        self._write()
+        return await super().find_one_and_replace(collection, filter, replacement, upsert)
+
+
+def test_insert_once_skips_duplicates(db):
+    info = Indexer(db).info(10)
+    doc = {"land_id": felt(1), "log_index": 3, "reason": "init", "map": []}
+
+    assert asyncio.run(insert_once(info, "map_checkpoints", dict(doc)))
+    assert not asyncio.run(insert_once(info, "map_checkpoints", dict(doc)))
+    assert db["map_checkpoints"].count_documents({}) == 1
+
+
+def test_applied_positions():
+    position = event_position(12, 4)
+    assert not applied(None, position)
+    assert not applied({}, position)
+    assert not applied({"applied_at": event_position(12, 3)}, position)
+    assert applied({"applied_at": position}, position)
+    assert applied({"applied_at": event_position(13, 0)}, position)
+    assert not_applied({"land_id": 1}, position) == {"land_id": 1, "applied_at": {"$not": {"$gte": position}}}
+
+
+def test_event_handled_twice(db):
+    indexer = Indexer(db, LiveCache())
+    indexer.handle_blocks(last=11)
+    for handler, block, log_index, data in indexer.events:
+        if block != 12:
+            continue
+        indexer.handle(handler, block, log_index, data)
+        documents = current_documents(db)
+        copies = live_copies(indexer.live, LAND_IDS)
+        indexer.handle(handler, block, log_index, data)
+        assert current_documents(db) == documents
+        assert live_copies(indexer.live, LAND_IDS) == copies
+
+
+@pytest.mark.parametrize("block", [9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20])
+def test_block_handled_twice(db, reference, block):
+    indexer = Indexer(db, LiveCache())
+    indexer.handle_blocks(last=block)
+    documents = current_documents(db)
+    copies = live_copies(indexer.live, LAND_IDS)
+
+    indexer.handle_block(block)
+    assert current_documents(db) == documents
+    assert live_copies(indexer.live, LAND_IDS) == copies
+
+    indexer.handle_blocks(first=block + 1)
+    assert current_documents(db) == reference
+
+
+@pytest.mark.parametrize("writes", range(12))
+def test_unfinished_block_invalidated(db, reference, writes):
+    indexer = Indexer(db)
+    indexer.handle_blocks(last=11)
+    # the indexer stops in the middle of block 12
+    with pytest.raises(Crash):
+        storage = CrashingStorage(db, 12, writes)
+        for handler, block, log_index, data in indexer.events:
+            if block == 12:
+                indexer.handle(handler, block, log_index, data, storage)
+
+    # on restart the writes of the block are discarded before it is delivered again
+    assert unfinished_block(db, indexer_id) == 12
+    indexer.invalidate(12)
+    indexer.handle_blocks(first=12)
+    assert current_documents(db) == reference
+
+
+def test_rollback_restores_the_live_copies(db):
+    indexer = Indexer(db, LiveCache())
+    indexer.handle_blocks(last=15)
+    copies = live_copies(indexer.live, LAND_IDS)
+
+    indexer.handle_blocks(first=16)
+    assert live_copies(indexer.live, LAND_IDS) != copies
+    assert indexer.live.rollback(16)
+    assert live_copies(indexer.live, LAND_IDS) == copies
+
+    # the rolled back copies match the invalidated documents
+    indexer.invalidate(16)
+    loaded = LiveCache()
+    loaded.preload(db, ["lands"], workers=1)
+    assert live_copies(loaded, LAND_IDS) == copies
+
+
+def test_rollback_deeper_than_the_undo_log(db):
+    indexer = Indexer(db, LiveCache(undo_blocks=3))
+    indexer.handle_blocks()
+    assert not indexer.live.rollback(12)
+    assert live_copies(indexer.live, LAND_IDS) == dict.fromkeys(LAND_IDS)